@@ -0,0 +1,237 @@
+# 大喜利アンサーの性能計測：テロップ画像・音声合成・動画生成を決まった条件で測り、基準値と比べる
+#
+# 使い方（リポジトリ直下で実行）:
+#   python bench.py                      全ケースを測って表示（基準値があれば比較する）
+#   python bench.py --save-baseline      測った結果を基準値として保存する
+#   python bench.py --quick --repeat 1   動画は縦横1ケースずつだけ測る
+#
+# TTS と Gemini は手元で決まった結果を返す偽物に差し替えるので、ネットにつながっていなくても動き、
+# 毎回同じ入力で測れる。各ケースは別プロセスで動かし、キャッシュもケースごとに空の一時ディレクトリを使う
+# （前のケースのキャッシュやメモリ使用量が次のケースに混ざらないように）。
+# 基準値より threshold 以上遅くなった項目があれば REGRESSION と表示し、終了コード 1 を返す。
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+BASELINE_FILE = "bench_baseline.json"
+
+ODAI = ("目に入れても痛くない孫に おじいちゃんがブチギレ。いったい何があった？",
+        "めにいれてもいたくないまごに_おじいちゃんがブチギレ。いったいなにがあった？")
+ANSWERS = {
+    "short": ("入れ歯を売った", "いればをうった"),
+    "long": ("おじいちゃんの入れ歯を メルカリで『ビンテージ雑貨』として 出品していた",
+             "おじいちゃんのいればを_メルカリで_ビンテージざっかとして_しゅっぴんしていた"),
+    "pauses": ("入れ歯を メルカリで 出品",
+               "いればを____メルカリで____しゅっ__ぴん______していた"),
+}
+VIDEO_MODES = {"vertical": "縦動画 (9:16)", "horizontal": "横動画 (16:9)"}
+
+CASES = (
+    [{"name": "text_image", "kind": "text"}]
+    + [{"name": f"audio_{a}", "kind": "audio", "answer": a} for a in ANSWERS]
+    + [{"name": f"video_{m}_{a}", "kind": "video", "mode": m, "answer": a} for m in VIDEO_MODES for a in ANSWERS]
+)
+QUICK_CASES = {"text_image", "audio_short", "audio_pauses", "video_vertical_short", "video_horizontal_long"}
+
+# --- 偽の TTS・LLM（入力だけで結果が決まる） ---
+def fake_tts_file(text, filename):
+    """文字数に比例した長さの正弦波を mp3 で書く（周波数は文字列のハッシュで決める）"""
+    import oogiri_core as core
+    duration = 0.12 * max(1, len(text))
+    freq = 200 + int(hashlib.sha1(text.encode("utf-8")).hexdigest(), 16) % 600
+    subprocess.run(
+        [core.FFMPEG_BIN, "-y", "-loglevel", "error", "-f", "lavfi",
+         "-i", f"sine=frequency={freq}:duration={duration:.2f}", "-ac", "2", filename],
+        check=True,
+    )
+
+class FakeGTTS:
+    def __init__(self, text, lang="ja"):
+        self.text = text
+
+    def save(self, filename):
+        fake_tts_file(self.text, filename)
+
+async def fake_edge_voice(text, filename, voice_name, rate="+20%"):
+    fake_tts_file(text, filename)
+
+class FakeLLMBackend:
+    def generate(self, model, prompt, params):
+        return "1. ベンチマーク用のお題です。いったい何があった？"
+
+    def stream(self, model, prompt, params):
+        yield "".join(f"{i}. ベンチマーク回答{i}\n" for i in range(1, 21))
+
+def setup(workdir):
+    """偽物への差し替えと、キャッシュ・出力先の一時ディレクトリへの付け替え"""
+    import oogiri_core as core
+    core.gTTS = FakeGTTS
+    core.save_edge_voice = fake_edge_voice
+    core.get_llm_client = lambda: core.LLMClient(FakeLLMBackend(), cache_dir=os.path.join(workdir, "llm"))
+    core.TTS_CACHE_DIR = os.path.join(workdir, "tts")
+    core.INTRO_CACHE_DIR = os.path.join(workdir, "intro")
+    core.FRAME_CACHE_DIR = os.path.join(workdir, "frames")
+    core.OUTPUT_DIR = os.path.join(workdir, "outputs")
+    core.TRACE_FILE = os.path.join(workdir, "trace.jsonl")
+    core.set_tracing(True)
+    return core
+
+def peak_rss_mb():
+    import resource
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / 1024, 1)
+
+def stage_totals(core):
+    """このケースで記録された段階ごとの実時間の合計"""
+    totals = {}
+    for r in core.read_recent_traces(path=core.TRACE_FILE):
+        totals[r["stage"]] = round(totals.get(r["stage"], 0.0) + r["wall"], 4)
+    return totals
+
+def run_case(case):
+    """1ケースを測って結果の dict を返す（--run-case で呼ばれる子プロセス側）"""
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    try:
+        core = setup(workdir)
+        result = {"name": case["name"]}
+        if case["kind"] == "text":
+            texts = [ODAI[0]] + [a[0] for a in ANSWERS.values()]
+            layouts = [core.get_layout(m) for m in VIDEO_MODES.values()]
+            start = time.perf_counter()
+            for layout in layouts:
+                for text in texts:
+                    core.create_text_image(text, 100, "black", pos=layout["pos_ans"], canvas_size=layout["target_size"])
+            cold = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(100):
+                for layout in layouts:
+                    for text in texts:
+                        core.create_text_image(text, 100, "black", pos=layout["pos_ans"], canvas_size=layout["target_size"])
+            hot = time.perf_counter() - start
+            calls = len(layouts) * len(texts)
+            result.update(e2e=round(cold, 4), cold_ms=round(cold / calls * 1000, 3), hot_ms=round(hot / (calls * 100) * 1000, 4))
+        elif case["kind"] == "audio":
+            text = core.clean_answer_text(ANSWERS[case["answer"]][1])
+            # 偽 TTS の生成時間は測らない（ミックスとデコードだけを見る）
+            core.prefetch_tts(text, "gtts")
+            os.remove(core.TRACE_FILE)
+            start = time.perf_counter()
+            clip = core.build_controlled_audio(text, "gtts")
+            result.update(e2e=round(time.perf_counter() - start, 4), seconds=round(clip.duration, 2) if clip else 0)
+        else:
+            display, audio = ANSWERS[case["answer"]]
+            start = time.perf_counter()
+            out = core.render_geki_video(ODAI[0], ODAI[1], display, audio, VIDEO_MODES[case["mode"]],
+                                    backend=case["backend"], profile=case["profile"])
+            e2e = time.perf_counter() - start
+            frames = round(core.media_duration(out) * core.ENCODE_PROFILES[case["profile"]]["fps"])
+            result.update(e2e=round(e2e, 4), fps=round(frames / e2e, 2), frames=frames)
+        result.update(stages=stage_totals(core), peak_rss_mb=peak_rss_mb())
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def spawn_case(case):
+    """ケースを別プロセスで動かして結果を受け取る"""
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run-case", json.dumps(case, ensure_ascii=False)],
+        capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"{case['name']} が失敗しました:\n{proc.stderr[-2000:]}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def measure(case, repeat):
+    """repeat 回測って、実時間が中央値の回の結果を返す"""
+    runs = sorted((spawn_case(case) for _ in range(repeat)), key=lambda r: r["e2e"])
+    result = runs[len(runs) // 2]
+    result["e2e_runs"] = [r["e2e"] for r in runs]
+    result["e2e_spread"] = round(statistics.pstdev(result["e2e_runs"]), 4) if len(runs) > 1 else 0.0
+    return result
+
+def compare(result, base, threshold):
+    """基準値より threshold 以上遅い（大きい）項目を返す"""
+    regressions = []
+    pairs = [("e2e", result.get("e2e"), base.get("e2e"))]
+    pairs += [(f"stage:{k}", v, base.get("stages", {}).get(k)) for k, v in result.get("stages", {}).items()]
+    pairs += [("peak_rss_mb", result.get("peak_rss_mb"), base.get("peak_rss_mb"))]
+    for key, now, before in pairs:
+        # ごく短い区間は誤差が大きいので比べない
+        if before is None or now is None or before < 0.01:
+            continue
+        if now > before * (1 + threshold):
+            regressions.append(f"{key}: {before} → {now} (+{(now / before - 1) * 100:.0f}%)")
+    # fps は小さくなったら悪化
+    if base.get("fps") and result.get("fps") and result["fps"] < base["fps"] / (1 + threshold):
+        regressions.append(f"fps: {base['fps']} → {result['fps']}")
+    return regressions
+
+def report(result):
+    line = f"{result['name']:<28} e2e {result['e2e']:>8.3f}s"
+    if "fps" in result:
+        line += f"  {result['fps']:>6.2f} fps"
+    if "cold_ms" in result:
+        line += f"  cold {result['cold_ms']:.2f}ms hot {result['hot_ms']:.4f}ms"
+    line += f"  peak {result['peak_rss_mb']}MB"
+    print(line, flush=True)
+    stages = result.get("stages", {})
+    if stages:
+        print("    " + "  ".join(f"{k}={v:.3f}s" for k, v in sorted(stages.items(), key=lambda kv: -kv[1])), flush=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="レンダリング処理の性能計測")
+    parser.add_argument("--backend", default=None, help="動画合成のバックエンド（省略時は OOGIRI_RENDER_BACKEND）")
+    parser.add_argument("--profile", default="final", help="動画のエンコード設定（ENCODE_PROFILES の名前）")
+    parser.add_argument("--repeat", type=int, default=3, help="各ケースの実行回数（中央値を採用）")
+    parser.add_argument("--quick", action="store_true", help="代表的なケースだけ測る")
+    parser.add_argument("--only", default=None, help="名前にこの文字列を含むケースだけ測る")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="結果を基準値として保存する")
+    parser.add_argument("--threshold", type=float, default=0.15, help="悪化とみなす割合（0.15 = 15%%）")
+    parser.add_argument("--run-case", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case)), ensure_ascii=False))
+        return 0
+
+    import oogiri_core as core
+    backend = args.backend or core.RENDER_BACKEND
+    cases = [dict(c, backend=backend, profile=args.profile) for c in CASES
+             if (not args.quick or c["name"] in QUICK_CASES) and (not args.only or args.only in c["name"])]
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    key = f"backend={backend} profile={args.profile}"
+
+    print(f"# backend={backend} profile={args.profile} repeat={args.repeat} threshold={args.threshold:.0%}", flush=True)
+    results = {}
+    regressed = False
+    for case in cases:
+        result = measure(case, args.repeat)
+        results[case["name"]] = result
+        report(result)
+        base = baseline.get(key, {}).get(case["name"])
+        if base and not args.save_baseline:
+            for r in compare(result, base, args.threshold):
+                regressed = True
+                print(f"    REGRESSION {r}", flush=True)
+
+    if args.save_baseline:
+        baseline.setdefault(key, {}).update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+        print(f"# 基準値を {args.baseline} に保存しました")
+    return 1 if regressed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
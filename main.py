@@ -1,33 +1,21 @@
-import re
 import os
 import random
-import asyncio
-import numpy as np
+from datetime import datetime
 import streamlit as st
-import google.generativeai as genai
-from PIL import Image, ImageDraw, ImageFont
-from moviepy.editor import VideoFileClip, ImageClip, CompositeVideoClip, AudioFileClip, CompositeAudioClip, concatenate_audioclips, AudioClip
-from gtts import gTTS
-import edge_tts
-import json
-from datetime import datetime, timezone, timedelta
+from oogiri_core import (
+    JST, RENDER_BACKEND, ANSWER_COUNT, configure_gemini,
+    get_learning_store, get_render_queue, text_cache_stats, scan_import, iter_json_records,
+    generate_odais, stream_answers,
+    tracing_enabled, set_tracing, trace_summary, keyframe_previews,
+)
 
 # --- 1. 基本設定 ---
 if "GEMINI_API_KEY" in st.secrets:
-    genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
+    # 実際の設定は最初にお題・回答を生成するときに1回だけ行う（再実行のたびに設定し直さない）
+    configure_gemini(st.secrets["GEMINI_API_KEY"])
 else:
     st.error("APIキーがSecretsに設定されていません。")
 
-CHOSEN_MODEL = 'models/gemini-2.0-flash'
-FONT_PATH = "NotoSansJP-Bold.ttf"
-BASE_VIDEO = "template.mp4"
-
-# ここで定義（関数の外に書くことで、どこからでも参照可能になります）
-SOUND1 = "sound1_v2.mp3"
-SOUND2 = "sound2.mp3"
-
-JST = timezone(timedelta(hours=9))  # ★日本時間用
-
 st.set_page_config(page_title="大喜利アンサー", layout="wide")
 
 # UIデザインのカスタマイズ
@@ -75,261 +63,11 @@ if 'selected_odai_pron' not in st.session_state: st.session_state.selected_odai_
 if 'ans_list' not in st.session_state: st.session_state.ans_list = []
 if 'pronounce_list' not in st.session_state: st.session_state.pronounce_list = []
 
-# ★学習データの読み込み
-DATA_FILE = "learning_data.json"
-
-def load_data():
-    """起動時に学習データを読み込む"""
-    if os.path.exists(DATA_FILE):
-        try:
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                # styleがないデータには"通常"を自動補完
-                for item in data:
-                    if 'style' not in item:
-                        item['style'] = '通常'
-                return data
-        except Exception as e:
-            st.error(f"データ読み込みエラー: {e}")
-    
-    # デフォルトデータ
-    return [
-        {"odai": "目に入れても痛くない孫におじいちゃんがブチギレ。いったい何があった？", "ans": "おじいちゃんの入れ歯をメルカリで『ビンテージ雑貨』として出品していた", "style": "通常"},
-        {"odai": "この番組絶対ドッキリだろ！なぜ気付いた？", "ans": "通行人10人全員がよく見たらエキストラのバイト募集で見かけた顔だった", "style": "通常"},
-        {"odai": "ハゲてて良かった～なぜそう思った？", "ans": "職質のプロに『君、隠し事なさそうな頭してるね』とスルーされた", "style": "通常"},
-        {"odai": "ハゲてて良かった～なぜそう思った？", "ans": "美容師さんにお任せでと言ったら3秒で会計が終わった", "style": "通常"},
-        {"odai": "母親が私の友達に大激怒。いったい何があった？", "ans": "家族写真のお母さんの顔の部分だけに執拗に『ブサイクになるフィルター』をかけて保存した", "style": "通常"},
-        {"odai": "母親が私の友達に大激怒。いったい何があった？", "ans": "おばさんその服カーテンと同じ柄ですね！と明るく指摘した", "style": "通常"}
-    ]
-
-if 'golden_examples' not in st.session_state:
-    st.session_state.golden_examples = load_data()
-
-# --- 3. ロジック ---
-
-def save_data():
-    """学習データを自動保存"""
-    try:
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(st.session_state.golden_examples, f, ensure_ascii=False, indent=2)
-        return True
-    except Exception as e:
-        st.error(f"保存エラー: {e}")
-        return False
-
-async def save_edge_voice(text, filename, voice_name, rate="+20%"):
-    communicate = edge_tts.Communicate(text, voice_name, rate=rate)
-    await communicate.save(filename)
-
-def make_silence(duration):
-    return AudioClip(lambda t: [0, 0], duration=duration, fps=44100)
-
-def build_controlled_audio(full_text, mode="gtts"):
-    parts = re.split(r'(_+)', full_text)
-    clips = []
-    for i, part in enumerate(parts):
-        if not part: continue
-        if '_' in part:
-            # --- 修正：0.1 を 0.06 に変更 ---
-            duration = len(part) * 0.06
-            clips.append(make_silence(duration))
-        else:
-            tmp_filename = f"part_{mode}_{i}.mp3"
-            if mode == "gtts":
-                tts = gTTS(part, lang='ja')
-                tts.save(tmp_filename)
-            else:
-                asyncio.run(save_edge_voice(part, tmp_filename, "ja-JP-KeitaNeural", rate="+15%"))
-            clips.append(AudioFileClip(tmp_filename))
-    if not clips: return None
-    return concatenate_audioclips(clips)
-
-# --- 修正：引数に canvas_size を追加し、サイズを可変にする ---
-def create_text_image(text, fontsize, color, pos, canvas_size=(1920, 1080)):
-    # 固定の (1920, 1080) ではなく、渡された canvas_size を使う
-    img = Image.new("RGBA", canvas_size, (255, 255, 255, 0))
-    draw = ImageDraw.Draw(img)
-    try: 
-        font = ImageFont.truetype(FONT_PATH, fontsize)
-    except: 
-        font = ImageFont.load_default()
-    
-    clean_display = text.replace("_", "")
-    display_text = clean_display.replace("　", "\n").replace(" ", "\n")
-    lines = [l for l in display_text.split("\n") if l.strip()]
-    if not lines: lines = [" "]
-    
-    line_spacing = 15
-    line_heights = [draw.textbbox((0, 0), line, font=font)[3] - draw.textbbox((0, 0), line, font=font)[1] for line in lines]
-    total_height = sum(line_heights) + (len(lines) - 1) * line_spacing
-    
-    current_y = pos[1] - total_height // 2
-    for i, line in enumerate(lines):
-        bbox = draw.textbbox((0, 0), line, font=font)
-        line_w = bbox[2] - bbox[0]
-        draw.text((pos[0] - line_w // 2, current_y), line, font=font, fill=color)
-        current_y += line_heights[i] + line_spacing
-    
-    return np.array(img)
-    draw = ImageDraw.Draw(img)
-    try: 
-        font = ImageFont.truetype(FONT_PATH, fontsize)
-    except: 
-        font = ImageFont.load_default()
-    
-    clean_display = text.replace("_", "")
-    display_text = clean_display.replace("　", "\n").replace(" ", "\n")
-    lines = [l for l in display_text.split("\n") if l.strip()]
-    if not lines: lines = [" "]
-    
-    line_spacing = 15
-    line_heights = [draw.textbbox((0, 0), line, font=font)[3] - draw.textbbox((0, 0), line, font=font)[1] for line in lines]
-    total_height = sum(line_heights) + (len(lines) - 1) * line_spacing
-    
-    current_y = pos[1] - total_height // 2
-    for i, line in enumerate(lines):
-        bbox = draw.textbbox((0, 0), line, font=font)
-        line_w = bbox[2] - bbox[0]
-        draw.text((pos[0] - line_w // 2, current_y), line, font=font, fill=color)
-        current_y += line_heights[i] + line_spacing
-    
-    return np.array(img)
-
-# --- 修正後：引数に video_mode を追加し、縦横の設定を分岐 ---
-
-def create_geki_video(odai_display, odai_audio, answer_display, answer_audio, video_mode):
-    global SOUND1, SOUND2  # これを追加！外側の変数を使うという宣言です
-    import datetime
-    jst = datetime.timezone(datetime.timedelta(hours=9))
-    timestamp = datetime.datetime.now(jst).strftime('%Y%m%d_%H%M%S')
-    out = f"{timestamp}.mp4" 
-
-    # --- 形式に応じたレイアウト設定（100%制御） ---
-    if video_mode == "縦動画 (9:16)":
-        target_size = (1080, 1920)
-        current_template = "template_v.mp4"
-        # 縦動画用の配置（中央付近にレイアウト）
-        pos_odai_main = (540, 850)   # お題（メイン）
-        pos_odai_sub = (540, 500)    # お題（サブ・上部）
-        pos_ans = (540, 850)        # 回答（中央やや下）
-    else:
-        # ★横動画の設定（今までの位置を維持）
-        target_size = (1920, 1080)
-        current_template = BASE_VIDEO
-        pos_odai_main = (960, 530)
-        pos_odai_sub = (880, 300)
-        pos_ans = (960, 500)
-
-    # チェック対象を current_template に変更
-    for f in [current_template, SOUND1, SOUND2]:
-        if not os.path.exists(f): 
-            st.error(f"ファイルが見つかりません: {f}")
-            return None
-            
-    try:
-        # テンプレートを current_template に変更
-        video = VideoFileClip(current_template).without_audio()
-        
-        # --- 修正後：文字数に応じた自動サイズ調整ロジック ---
-        clean_ans_disp = re.sub(r'^[0-9０-９\.\s、。・＊\*]+', '', answer_display).strip()
-        clean_ans_aud = re.sub(r'^[0-9０-９\.\s、。・＊\*]+', '', answer_audio).strip()
-
-        # 文字数をカウント
-        # --- 修正後：お題と回答の両方を自動サイズ調整 ---
-        
-        # 1. お題（メイン）のサイズ調整ロジック
-        # --- 修正：お題と回答の最大サイズを 120 で統一 ---
-        
-        # 1. お題（メイン）のサイズ調整
-        # --- 修正：すべてのテキスト（メイン・サブ・回答）を自動調整 ---
-        
-        # --- 決定版：すべてのテキストを自動調整（重複を排除） ---
-        
-        # 1. お題（メイン：i1）のサイズ調整
-        odai_len = len(odai_display)
-        if odai_len <= 10:
-            odai_main_fontsize = 120
-        elif odai_len <= 20:
-            odai_main_fontsize = 100
-        elif odai_len <= 30:
-            odai_main_fontsize = 80
-        else:
-            odai_main_fontsize = 65
-
-        # 2. お題サブ (i2: 背景パネル用) のサイズ
-        # 150から、パネルにちょうど収まる「100」前後に戻します
-        if odai_len <= 10:
-            odai_sub_fontsize = 120   # ★ここを150から120へ
-        elif odai_len <= 20:
-            odai_sub_fontsize = 100    # ★ここを75から100へ
-        elif odai_len <= 30:
-            odai_sub_fontsize = 80    # ★ここを80へ
-        else:
-            odai_sub_fontsize = 80    # ★ここも80に修正した
-
-        # 3. 回答（i3）のサイズ調整
-        ans_len = len(clean_ans_disp)
-        if ans_len <= 10:
-            ans_fontsize = 120
-        elif ans_len <= 20:
-            ans_fontsize = 100
-        else:
-            ans_fontsize = 80
+st.session_state.golden_examples = get_learning_store().all()
+EDIT_PAGE_SIZE = 20   # 学習データ編集画面の1ページの件数
 
-        # --- 画像生成（決定したフォントサイズを反映） ---
-        i1 = create_text_image(odai_display, odai_main_fontsize, "black", pos=pos_odai_main, canvas_size=target_size) 
-        i2 = create_text_image(odai_display, odai_sub_fontsize, "black", pos=pos_odai_sub, canvas_size=target_size)
-        i3 = create_text_image(clean_ans_disp, ans_fontsize, "black", pos=pos_ans, canvas_size=target_size)
-        
-        c1 = ImageClip(i1).set_start(2.0).set_end(8.0)
-        c2 = ImageClip(i2).set_start(8.0).set_end(10.0)
-        c3 = ImageClip(i3).set_start(10.0).set_end(16.0)
-        
-        # 音声合成の処理（変更なし）
-        voice_odai_clip = build_controlled_audio(odai_audio, mode="gtts")
-        voice_ans_clip = build_controlled_audio(clean_ans_aud, mode="edge")
-        
-        audio_list = []
-        if voice_odai_clip: audio_list.append(voice_odai_clip.set_start(2.5))
-        if voice_ans_clip: audio_list.append(voice_ans_clip.set_start(10.5))
-        
-        # 呪いを解く「絶対固定」のロジック
-        if os.path.exists(SOUND1):
-            # normalizeは素材に依存して計算がブレるため、あえて削除。
-            # 直接、数値で叩く。これが最も「計算ミス」が起きない形です。
-            s1_clip = AudioFileClip(SOUND1).set_start(0.8).volumex(0.03)
-            audio_list.append(s1_clip)
-            
-        if os.path.exists(SOUND2):
-            s2_clip = AudioFileClip(SOUND2).set_start(9.0).volumex(0.2)
-            audio_list.append(s2_clip)
-        
-        # ★size を target_size に変更
-        final = CompositeVideoClip([video, c1, c2, c3], size=target_size).set_audio(CompositeAudioClip(audio_list))
-        
-        final.write_videofile(out, fps=24, codec="libx264", audio_codec="aac", logger=None)
-        
-        # すべてのクリップを物理的に閉じる（キャッシュ汚染を防ぐ）
-        video.close()
-        if voice_odai_clip: voice_odai_clip.close()
-        if voice_ans_clip: voice_ans_clip.close()
-        if os.path.exists(SOUND1): s1_clip.close()
-        if os.path.exists(SOUND2): s2_clip.close()
-        final.close()
-        
-        return out
-        
-        video.close()
-        if voice_odai_clip: voice_odai_clip.close()
-        if voice_ans_clip: voice_ans_clip.close()
-        final.close()
-        
-        return out
-    except Exception as e:
-        st.error(f"合成失敗: {e}")
-        import traceback
-        st.error(traceback.format_exc())
-        return None
+# 「縦・横まとめて書き出し」で作る組み合わせ（Shorts 用と通常の YouTube 用）
+PUBLISH_TARGETS = [("縦動画 (9:16)", "final"), ("横動画 (16:9)", "final")]
 
 # --- 4. サイドバー ---
 with st.sidebar:
@@ -345,25 +83,18 @@ with st.sidebar:
         
         if st.form_submit_button("感性を覚えさせる"):
             if new_odai and new_ans:
-                is_duplicate = any(
-                    ex["odai"] == new_odai and ex["ans"] == new_ans 
-                    for ex in st.session_state.golden_examples
-                )
-                if not is_duplicate:
-                    # ★修正：固定の "通常" ではなく、選んだ new_style を保存する
-                    st.session_state.golden_examples.append({
-                        "odai": new_odai, 
-                        "ans": new_ans, 
-                        "style": new_style 
-                    })
-                    if save_data():
+                # ★修正：固定の "通常" ではなく、選んだ new_style を保存する
+                try:
+                    added_id = get_learning_store().add(new_odai, new_ans, new_style)
+                except Exception as e:
+                    st.error(f"❌ 保存に失敗しました: {e}")
+                else:
+                    if added_id is not None:
                         st.success("✅ 登録し、保存しました")
                         # 画面をリロードして反映
                         st.rerun() 
                     else:
-                        st.error("❌ 登録しましたが保存に失敗しました")
-                else:
-                    st.warning("⚠️ すでに登録されています")
+                        st.warning("⚠️ すでに登録されています")
     
     st.write("---")
     st.subheader("💾 データ管理")
@@ -371,93 +102,133 @@ with st.sidebar:
     # --- 追加：学習データ編集・削除機能 ---
     if st.session_state.golden_examples:
         with st.expander("📝 登録済みデータの編集・削除"):
-            for idx, item in enumerate(st.session_state.golden_examples):
+            # --- 修正：全件分の入力欄を毎回作ると重いので、検索・絞り込みした1ページ分だけ作る ---
+            col_q1, col_q2 = st.columns([3, 2])
+            edit_query = col_q1.text_input("検索（お題・回答）", key="edit_query", placeholder="文字列で絞り込み")
+            edit_style = col_q2.selectbox("種別", ["すべて", "通常", "知的", "ブラック"], key="edit_style_filter")
+            # 条件が変わったら1ページ目に戻す
+            edit_filter = (edit_query, edit_style)
+            if st.session_state.get("edit_filter") != edit_filter:
+                st.session_state.edit_filter = edit_filter
+                st.session_state.edit_page = 1
+
+            store = get_learning_store()
+            total, _ = store.find(edit_query, None if edit_style == "すべて" else edit_style, limit=0)
+            pages = max(1, -(-total // EDIT_PAGE_SIZE))
+            st.session_state.edit_page = min(st.session_state.get("edit_page", 1), pages)
+            page = st.number_input(f"ページ（全{pages}ページ・{total}件）", min_value=1, max_value=pages, step=1, key="edit_page")
+            _, page_items = store.find(edit_query, None if edit_style == "すべて" else edit_style,
+                                       offset=(page - 1) * EDIT_PAGE_SIZE, limit=EDIT_PAGE_SIZE)
+
+            for item in page_items:
+                # ウィジェットのキーは並び順ではなく id に紐付ける（削除で他の行の入力がずれないように）
+                item_id = item["id"]
                 col_e1, col_e2, col_e3 = st.columns([2, 5, 1])
                 
                 # ユーモア種類の変更
                 new_item_style = col_e1.selectbox(
-                    f"種別 {idx}", ["通常", "知的", "ブラック"], 
+                    f"種別 {item_id}", ["通常", "知的", "ブラック"], 
                     index=["通常", "知的", "ブラック"].index(item.get("style", "通常")),
-                    key=f"edit_style_{idx}", label_visibility="collapsed"
+                    key=f"edit_style_{item_id}", label_visibility="collapsed"
                 )
                 
                 # 回答内容の修正（text_input から text_area に変更し、高さを調整）
+                col_e2.caption(item["odai"])
                 new_item_ans = col_e2.text_area(
-                    f"回答 {idx}", value=item["ans"], 
+                    f"回答 {item_id}", value=item["ans"], 
                     height=80,  # 約2〜3行分の高さ
-                    key=f"edit_ans_{idx}", label_visibility="collapsed"
+                    key=f"edit_ans_{item_id}", label_visibility="collapsed"
                 )
                 
                 # 削除ボタン
-                if col_e3.button("❌", key=f"del_{idx}"):
-                    st.session_state.golden_examples.pop(idx)
-                    save_data()
+                if col_e3.button("❌", key=f"del_{item_id}"):
+                    store.delete(item_id)
                     st.rerun()
                 
-                # 値が変更されたら即座に反映
+                # 値が変更されたら即座に反映（変わった1件だけを書き込む）
                 if new_item_style != item.get("style") or new_item_ans != item["ans"]:
-                    st.session_state.golden_examples[idx]["style"] = new_item_style
-                    st.session_state.golden_examples[idx]["ans"] = new_item_ans
-                    save_data()
+                    if not store.update(item_id, ans=new_item_ans, style=new_item_style):
+                        st.warning("⚠️ 同じお題・回答がすでに登録されています")
     # ------------------------------------
     
     # エクスポート（★日本時間に修正）
     if st.session_state.golden_examples:
-        json_str = json.dumps(st.session_state.golden_examples, ensure_ascii=False, indent=2)
         timestamp = datetime.now(JST).strftime('%Y%m%d_%H%M%S')  # ★JST適用
         st.download_button(
             "📥 エクスポート",
-            json_str,
+            # --- 修正：JSON は押されたときにだけ作る（再実行のたびに全件を書き出さない） ---
+            get_learning_store().export_json,
             file_name=f"learning_data_{timestamp}.json",
             mime="application/json",
             use_container_width=True
         )
     
     # インポート
-    uploaded_file = st.file_uploader("📁 インポート", type=['json'])
+    uploaded_file = st.file_uploader("📁 インポート", type=['json', 'jsonl'])
     
     if uploaded_file is not None:
         try:
-            imported_data = json.load(uploaded_file)
-            
-            for item in imported_data:
-                if 'style' not in item:
-                    item['style'] = '通常'
+            # --- 修正：ファイル全体を json.load せず、1件ずつ読んで数える（同じファイルは1回だけ） ---
+            if st.session_state.get("import_scan_id") != uploaded_file.file_id:
+                uploaded_file.seek(0)
+                st.session_state.import_scan = scan_import(uploaded_file)
+                st.session_state.import_scan_id = uploaded_file.file_id
+            valid_count, invalid_count = st.session_state.import_scan
             
-            st.info(f"📊 {len(imported_data)}件のデータが見つかりました")
+            st.info(f"📊 {valid_count}件のデータが見つかりました")
+            if invalid_count:
+                st.warning(f"⚠️ お題・回答・種類が正しくない{invalid_count}件は取り込みません")
             st.caption("統合方法を選択してください")
             
             col1, col2 = st.columns(2)
-            
+            import_mode = None
             with col1:
                 if st.button("➕ 追加", use_container_width=True, help="既存データを残して追加します（重複は自動除外）"):
-                    added_count = 0
-                    for item in imported_data:
-                        is_duplicate = any(
-                            ex["odai"] == item["odai"] and ex["ans"] == item["ans"]
-                            for ex in st.session_state.golden_examples
-                        )
-                        if not is_duplicate:
-                            st.session_state.golden_examples.append(item)
-                            added_count += 1
-                    
-                    if save_data():
-                        if added_count > 0:
-                            st.success(f"✅ {added_count}件を追加しました")
-                        if len(imported_data) - added_count > 0:
-                            st.info(f"ℹ️ 重複{len(imported_data)-added_count}件を除外しました")
-                        st.rerun()
+                    import_mode = "add"
             
             with col2:
                 if st.button("🔄 上書き", use_container_width=True, help="既存データを削除して置き換えます"):
-                    st.session_state.golden_examples = imported_data
-                    if save_data():
-                        st.success(f"✅ {len(imported_data)}件で上書きしました")
-                        st.rerun()
+                    import_mode = "replace"
+
+            if import_mode:
+                total = valid_count + invalid_count
+                bar = st.progress(0.0, text="取り込み中...")
+                def show_import_progress(done):
+                    bar.progress(min(1.0, done / max(1, total)), text=f"取り込み中... {done}/{total}件")
+                uploaded_file.seek(0)
+                # 重複はストアの一意インデックスで除外される
+                counts = get_learning_store().import_records(
+                    iter_json_records(uploaded_file),
+                    replace=import_mode == "replace", progress=show_import_progress,
+                )
+                if import_mode == "replace":
+                    st.success(f"✅ {counts['added']}件で上書きしました")
+                elif counts["added"] > 0:
+                    st.success(f"✅ {counts['added']}件を追加しました")
+                if counts["duplicates"] > 0:
+                    st.info(f"ℹ️ 重複{counts['duplicates']}件を除外しました")
+                st.rerun()
         
         except Exception as e:
             st.error(f"❌ インポートエラー: {e}")
 
+    # --- 処理段階ごとの所要時間（計測を有効にした間の記録から集計） ---
+    with st.expander("⏱️ 処理時間の計測"):
+        trace_on = st.checkbox("計測を有効にする", value=tracing_enabled(), key="trace_enabled")
+        if trace_on != tracing_enabled():
+            set_tracing(trace_on)
+        trace_rows = trace_summary()
+        if trace_rows:
+            st.dataframe(trace_rows, hide_index=True, use_container_width=True)
+        else:
+            st.caption("まだ記録がありません")
+
+    # --- キャッシュの効き具合（負荷時の確認用） ---
+    with st.expander("⚙️ キャッシュ状況"):
+        stats = text_cache_stats()
+        st.caption(f"テロップ画像: ヒット {stats['hits']} / ミス {stats['misses']} / 破棄 {stats['evictions']}")
+        st.caption(f"保持 {stats['entries']}件・{stats['bytes'] / 1024 / 1024:.1f}MB")
+
 # --- 5. メインUI ---
 st.title("大喜利アンサー")
 
@@ -485,6 +256,13 @@ video_mode = st.radio(
 
 # 最終的にシステムが使う変数を同期
 video_mode = st.session_state.video_mode_selector
+
+# 合成バックエンドの切り替え（レイアウトは同じで、ffmpeg の方が速い）
+use_ffmpeg = st.checkbox("⚡ 高速合成（ffmpeg）", value=(RENDER_BACKEND == "ffmpeg"), key="use_ffmpeg_backend")
+render_backend = "ffmpeg" if use_ffmpeg else "moviepy"
+# 「生成」はまず低解像度のプレビューで確認し、保存用は「本番画質で書き出し」で作る
+use_preview = st.checkbox("🔍 プレビュー画質で生成（低解像度・高速）", value=True, key="use_preview_profile")
+render_profile = "preview" if use_preview else "final"
 st.write("---") # 区切り線
 
 kw_col, clr_col, rnd_col = st.columns([5, 1, 1])
@@ -496,23 +274,12 @@ if rnd_col.button("ランダム"):
     st.session_state.kw = random.choice(["SNS", "古畑任三郎", "母親", "サウナ", "孫", "無人島"])
     st.rerun()
 
+# 同じキーワード・同じお題でも、あえて新しい案がほしいときはキャッシュを使わない
+force_fresh = st.checkbox("🔄 キャッシュを使わず新しく生成", value=False)
+
 if st.button("お題生成", use_container_width=True):
     with st.spinner("厳選中..."):
-        m = genai.GenerativeModel(CHOSEN_MODEL)
-        prompt = f"「{st.session_state.kw}」をテーマにした大喜利お題を3つ作れ。お題だけを3行で出力。"
-        r = m.generate_content(prompt)
-        
-        lines = r.text.split('\n')
-        odais = []
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            cleaned = re.sub(r'^[0-9０-９]+[\.．\s]+', '', line).strip()
-            if len(cleaned) >= 10:
-                odais.append(cleaned)
-        
+        odais = generate_odais(st.session_state.kw, force_fresh=force_fresh)
         st.session_state.odais = odais[:3]
         
         if not st.session_state.odais:
@@ -556,58 +323,78 @@ if st.session_state.selected_odai:
     
     if st.button("🚀 回答20案生成", type="primary", use_container_width=True):
         with st.spinner("爆笑を追求中..."):
-            m = genai.GenerativeModel(CHOSEN_MODEL)
-            ex_str = "\n".join([f"・{e['ans']}" for e in st.session_state.golden_examples])
-            
-            #p = f"""あなたは伝説の大喜利芸人です。
-
-#お題: {st.session_state.selected_odai}
-#雰囲気: {style}
-
-#参考となる傑作回答:
-#{ex_str}
-
-#指示:
-#1. 上記の手本を参考に、同じレベルの面白い回答を20個考えろ
-#2. 挨拶、説明、前置きは絶対に書くな
-#3. 番号付きリスト形式で出力しろ（1. 回答）
-#4. カッコ書きの説明は禁止
-#5. 回答だけを書け
-#"""
-            
-# --- 修正後：YouTubeチャンネル『大喜利アンサー』専用プロンプト ---
-            p = f"""あなたはYouTubeチャンネル『大喜利アンサー』を運営する伝説のクリエイター兼大喜利芸人です。
-視聴者が思わず吹き出し、チャンネル登録したくなるようなキレ味鋭い回答を生成してください。
-
-【お題】: {st.session_state.selected_odai}
-【ユーモアの方向性】: {style}
-
-【大喜利アンサー 傑作選（このトーンを再現せよ）】:
-{ex_str}
-
-【絶対ルール】:
-1. 傑作選の「視点の鋭さ」「短文での爆発力」を継承し、同等以上の回答を考えろ。
-2. 「ブラック」指定時は、YouTubeの規約に触れない絶妙なラインで、シュールかつ猛毒な笑いを攻めろ。
-3. 挨拶・前置き・「はい、回答します」等は一切禁止。即座に回答を始めろ。
-4. 番号付きリスト形式（1. 回答）で、正確に20案出力しろ。
-5. 言葉を削ぎ落とし、視聴者の想像力を刺激する一撃のフレーズを重視しろ。
-"""
-            r = m.generate_content(p)
-            
-            all_lines = [l.strip() for l in r.text.split('\n') if l.strip()]
+            # ストリーミングで受け取り、番号付きの行が届くたびに一覧へ足していく
             ans_raw = []
-            
-            for line in all_lines:
-                if re.match(r'^[0-9０-９]+[\.．、。\s]', line):
-                    if not any(word in line[:20] for word in ['はい', '承知', 'それでは', '以下', '提案']):
-                        # ★番号を削除してから追加
-                        cleaned_line = re.sub(r'^[0-9０-９]+[\.．、。\s]+', '', line).strip()
-                        ans_raw.append(cleaned_line)
+            preview = st.empty()
+            for ans in stream_answers(st.session_state.selected_odai, style, force_fresh=force_fresh):
+                ans_raw.append(ans)
+                st.session_state.ans_list = list(ans_raw)
+                st.session_state.pronounce_list = list(ans_raw)
+                preview.markdown("\n".join(f"{n}. {a}" for n, a in enumerate(ans_raw, 1)))
                                     
-            st.session_state.ans_list = ans_raw[:20]
-            st.session_state.pronounce_list = ans_raw[:20]
+            st.session_state.ans_list = ans_raw[:ANSWER_COUNT]
+            st.session_state.pronounce_list = ans_raw[:ANSWER_COUNT]
             st.rerun()
 
+# --- 生成ジョブの進捗：この部分だけを1秒ごとに描き直す（ページ全体は再実行しない） ---
+@st.fragment(run_every=1)
+def show_job_progress(key, on_done, label="🎬"):
+    """st.session_state[key] のジョブの進捗と取り消しボタン（終わったら on_done(ジョブ) を呼ぶ）
+
+    失敗したときは st.session_state[f"{key}_error"] に理由を残す（show_job_error で出す）。
+    """
+    job_id = st.session_state.get(key)
+    if job_id is None:
+        return
+    job = get_render_queue().get(job_id)
+    if job is None or job["state"] in ("done", "failed", "cancelled"):
+        del st.session_state[key]
+        if job is not None and job["state"] == "done":
+            on_done(job)
+        elif job is not None and job["state"] == "failed":
+            st.session_state[f"{key}_error"] = job["error"]
+        # 動画や保存ボタンはフラグメントの外にあるので、終わったときだけページ全体を描き直す
+        st.rerun()
+    col_prog, col_cancel = st.columns([9, 1])
+    col_prog.progress(job["progress"], text=f"{label} {job['stage']}")
+    if col_cancel.button("✖", key=f"cancel_{key}", help="この生成を取り消します"):
+        get_render_queue().cancel(job["id"])
+        st.rerun()
+
+def show_job_error(key, title):
+    if st.session_state.get(f"{key}_error"):
+        st.error(f"{title}: {st.session_state[f'{key}_error']}")
+
+def submit_job(key, submit, *args, **kwargs):
+    """ジョブキューに登録して ID を st.session_state[key] に入れる（混み合っているときは警告だけ出す）"""
+    st.session_state.pop(f"{key}_error", None)
+    try:
+        st.session_state[key] = submit(*args, **kwargs)
+        return True
+    except RuntimeError as e:
+        st.warning(str(e))
+        return False
+
+def video_done(i):
+    def on_done(job):
+        # ★変更点1：動画プレイヤーをここで出さず、パスだけを保存する
+        st.session_state[f"temp_video_{i}"] = job["result"]
+        st.session_state[f"temp_profile_{i}"] = job["profile"]
+    return on_done
+
+def publish_done(i):
+    def on_done(job):
+        st.session_state[f"publish_{i}_paths"] = job["result"]
+    return on_done
+
+def batch_done(job):
+    paths, errors = job["result"]
+    for i, path in enumerate(paths):
+        if path:
+            st.session_state[f"temp_video_{i}"] = path
+            st.session_state[f"temp_profile_{i}"] = job["profile"]
+    st.session_state.batch_errors = errors
+
 if st.session_state.ans_list:
     st.write("---")
     st.write("### 📋 回答一覧")
@@ -633,17 +420,37 @@ if st.session_state.ans_list:
             st.write("")
             st.write("")
             if st.button("生成", key=f"b_{i}"):
-                with st.spinner("動画生成中..."):
-                    path = create_geki_video(
-                        st.session_state.selected_odai, 
-                        st.session_state.selected_odai_pron, 
-                        st.session_state.ans_list[i], 
-                        st.session_state.pronounce_list[i],
-                        video_mode  # ★ここに追加した video_mode を渡します
-                    )
-                    # ★変更点1：動画プレイヤーをここで出さず、パスだけを保存する
-                    if path:
-                        st.session_state[f"temp_video_{i}"] = path
+                # ★生成はバックグラウンドのジョブに任せ、画面はすぐに返す
+                submit_job(
+                    f"job_{i}", get_render_queue().submit,
+                    st.session_state.selected_odai, 
+                    st.session_state.selected_odai_pron, 
+                    st.session_state.ans_list[i], 
+                    st.session_state.pronounce_list[i],
+                    video_mode,  # ★ここに追加した video_mode を渡します
+                    backend=render_backend,
+                    profile=render_profile
+                )
+            # 配置だけを静止画で確認（エンコードしないのですぐ出る）
+            if st.button("🖼️", key=f"kfbtn_{i}", help="テロップの配置を静止画で確認します"):
+                st.session_state[f"show_kf_{i}"] = not st.session_state.get(f"show_kf_{i}", False)
+
+        # --- 静止画での配置確認（5秒・9秒・13秒のコマ） ---
+        if st.session_state.get(f"show_kf_{i}"):
+            try:
+                keyframes = keyframe_previews(st.session_state.selected_odai, st.session_state.ans_list[i], video_mode)
+            except Exception as e:
+                st.error(f"配置プレビュー失敗: {e}")
+            else:
+                if any(overflow for _, _, overflow in keyframes):
+                    st.warning("⚠️ テロップが画面からはみ出しています。字幕を短くするか、スペースで改行してください")
+                for col_kf, (t, frame_img, _) in zip(st.columns(len(keyframes)), keyframes):
+                    col_kf.image(frame_img, caption=f"{t:g}秒", use_container_width=True)
+
+        # --- 生成ジョブの進捗表示（終わったら temp_video_{i} に入れる） ---
+        show_job_error(f"job_{i}", "合成失敗")
+        if f"job_{i}" in st.session_state:
+            show_job_progress(f"job_{i}", video_done(i))
 
         # ★変更点2：with col_button の外（インデントを戻した位置）で大きく表示する
         # ★修正箇所：if文の直後の行をすべて1段下げます
@@ -652,6 +459,9 @@ if st.session_state.ans_list:
         # --- 修正：動画表示と保存ボタンのブロック（強制サイズ固定版） ---
         # --- 修正：縦動画プレビュー時の全体幅制限 ---
         # --- 修正：動画表示と保存ボタンのブロック（縦横両方のサイズを最適化） ---
+        # 出力キャッシュの上限で消えた動画は表示しない（もう一度「生成」すれば作り直す）
+        if f"temp_video_{i}" in st.session_state and not os.path.exists(st.session_state[f"temp_video_{i}"]):
+            del st.session_state[f"temp_video_{i}"]
         if f"temp_video_{i}" in st.session_state:
             video_path = st.session_state[f"temp_video_{i}"]
             
@@ -686,14 +496,76 @@ if st.session_state.ans_list:
                 )
                 st.video(video_path)
             
+            # プレビュー画質のときは、同じ内容を本番画質で作り直せるようにする
+            if st.session_state.get(f"temp_profile_{i}") == "preview":
+                if st.button("🎞️ 本番画質で書き出し", key=f"final_{i}", use_container_width=True, disabled=f"job_{i}" in st.session_state):
+                    if submit_job(
+                        f"job_{i}", get_render_queue().submit,
+                        st.session_state.selected_odai, 
+                        st.session_state.selected_odai_pron, 
+                        st.session_state.ans_list[i], 
+                        st.session_state.pronounce_list[i],
+                        video_mode,
+                        backend=render_backend,
+                        profile="final"
+                    ):
+                        st.rerun()
+
+            # 縦・横の本番画質を、音声合成とテロップを共有して1回でまとめて作る（これもバックグラウンドのジョブ）
+            if st.button("📦 縦・横まとめて書き出し（本番画質）", key=f"publish_{i}", use_container_width=True,
+                         disabled=f"publish_job_{i}" in st.session_state):
+                if submit_job(
+                    f"publish_job_{i}", get_render_queue().submit_targets,
+                    st.session_state.selected_odai,
+                    st.session_state.selected_odai_pron,
+                    st.session_state.ans_list[i],
+                    st.session_state.pronounce_list[i],
+                    PUBLISH_TARGETS,
+                ):
+                    st.rerun()
+            show_job_error(f"publish_job_{i}", "まとめて書き出し失敗")
+            if f"publish_job_{i}" in st.session_state:
+                show_job_progress(f"publish_job_{i}", publish_done(i), label="📦")
+            publish_paths = st.session_state.get(f"publish_{i}_paths") or []
+            if publish_paths and all(os.path.exists(p) for p in publish_paths):
+                for col_pub, (mode, _), path in zip(st.columns(len(publish_paths)), PUBLISH_TARGETS, publish_paths):
+                    with open(path, "rb") as f:
+                        col_pub.download_button(
+                            f"💾 {mode}",
+                            f,
+                            file_name=f"{datetime.now(JST).strftime('%Y%m%d_%H%M%S')}_{'tate' if mode.startswith('縦') else 'yoko'}.mp4",
+                            key=f"dl_publish_{i}_{mode}",
+                            use_container_width=True
+                        )
+
             # 保存ボタン（共通）
             with open(video_path, "rb") as f:
                 st.download_button(
-                    "💾 保存", 
+                    "💾 保存（プレビュー画質）" if st.session_state.get(f"temp_profile_{i}") == "preview" else "💾 保存", 
                     f, 
-                    file_name=video_path, 
+                    file_name=f"{datetime.now(JST).strftime('%Y%m%d_%H%M%S')}.mp4",  # 保存名は従来どおり日本時間 
                     key=f"dl_final_perfect_{i}",
                     use_container_width=True
                 )
+
+    # --- 一括生成：お題の処理を共有して全回答をまとめて動画化（1つのジョブとして進捗を出す） ---
+    st.write("")
+    if st.button("🎬 全回答を一括生成", use_container_width=True, disabled="batch_job" in st.session_state):
+        st.session_state.pop("batch_errors", None)
+        if submit_job(
+            "batch_job", get_render_queue().submit_batch,
+            st.session_state.selected_odai,
+            st.session_state.selected_odai_pron,
+            list(zip(st.session_state.ans_list, st.session_state.pronounce_list)),
+            video_mode,
+            backend=render_backend,
+            profile=render_profile
+        ):
+            st.rerun()
+    show_job_error("batch_job", "一括合成失敗")
+    for n, err in sorted((st.session_state.get("batch_errors") or {}).items()):
+        st.error(f"回答 {n+1} の合成失敗: {err}")
+    if "batch_job" in st.session_state:
+        show_job_progress("batch_job", batch_done, label=f"🎬 {len(st.session_state.ans_list)}本を一括生成中:")
 st.write("---")
 st.caption("「私が100%制御しています」")
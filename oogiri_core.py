@@ -0,0 +1,2140 @@
+# 大喜利アンサーの処理本体（画面 main.py と一括処理 pipeline.py から使う）
+import re
+import os
+import time
+import asyncio
+import io
+import uuid
+import sqlite3
+import wave
+import codecs
+import hashlib
+import threading
+try:
+    import resource
+except ImportError:
+    resource = None
+from collections import OrderedDict
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import sys
+import functools
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+from gtts import gTTS
+import json
+from datetime import timezone, timedelta
+# google.generativeai・edge_tts・moviepy.editor は読み込みが重いので、使う関数の中で初めて import する
+# （画面の初回表示や、画面なしのスクリプトで使わない部分の読み込みを待たない）
+
+# Streamlit の画面から使われたとき（先に streamlit が読み込まれているとき）だけ st を使う。
+# 画面なしのスクリプト（pipeline.py・bench.py）では streamlit を読み込まない
+st = sys.modules.get("streamlit")
+
+def cache_resource(func=None, max_entries=None):
+    """プロセス内で共有するキャッシュ（画面では st.cache_resource、画面なしでは functools.lru_cache）"""
+    if func is None:
+        return functools.partial(cache_resource, max_entries=max_entries)
+    if st is not None:
+        # レンダリング用のスレッドからも呼ばれるので、スピナー（画面の文脈が要る）は出さない
+        return st.cache_resource(max_entries=max_entries, show_spinner=False)(func)
+    return functools.lru_cache(maxsize=max_entries)(func)
+
+def show_error(message):
+    """画面があれば st.error、なければ標準エラーに出す"""
+    if st is not None:
+        st.error(message)
+    else:
+        print(message, file=sys.stderr)
+
+# --- 1. 基本設定 ---
+CHOSEN_MODEL = 'models/gemini-2.0-flash'
+FONT_PATH = "NotoSansJP-Bold.ttf"
+BASE_VIDEO = "template.mp4"
+FFMPEG_BIN = get_setting("FFMPEG_BINARY")
+AUDIO_FPS = 44100
+
+# ここで定義（関数の外に書くことで、どこからでも参照可能になります）
+SOUND1 = "sound1_v2.mp3"
+SOUND2 = "sound2.mp3"
+
+JST = timezone(timedelta(hours=9))  # ★日本時間用
+
+# --- 計測：処理段階ごとの実時間・CPU 時間・メモリを JSON Lines に書き出す（無効時は何もしない） ---
+TRACE_FILE = os.path.join("cache", "trace.jsonl")
+TRACE_MAX_BYTES = 20 * 1024 * 1024
+TRACE_RECENT_LINES = 5000
+_trace = {"enabled": os.environ.get("OOGIRI_TRACE", "") == "1", "lock": threading.Lock()}
+
+class _NullSpan:
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+    def set(self, **attrs): pass
+
+_NULL_SPAN = _NullSpan()
+
+class Span:
+    """with で囲んだ区間を1行の記録にする
+
+    wall は実時間、cpu はこのプロセスの CPU 時間、child_cpu は区間内に終わった子プロセス（ffmpeg）の CPU 時間、
+    peak_rss_mb はその時点までのプロセスの最大メモリ。set() で属性を後から足せる。
+    """
+
+    def __init__(self, stage, attrs):
+        self.stage = stage
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        t = os.times()
+        self._start = (time.perf_counter(), t.user + t.system, t.children_user + t.children_system)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        t = os.times()
+        wall, cpu, child_cpu = self._start
+        record = {
+            "ts": round(time.time(), 3),
+            "stage": self.stage,
+            "wall": round(time.perf_counter() - wall, 4),
+            "cpu": round(t.user + t.system - cpu, 4),
+            "child_cpu": round(t.children_user + t.children_system - child_cpu, 4),
+            "peak_rss_mb": peak_rss_mb(),
+            "pid": os.getpid(),
+            "ok": exc_type is None,
+        }
+        record.update(self.attrs)
+        write_trace(record)
+        return False
+
+def span(stage, **attrs):
+    """計測区間（無効時は何もしない共有オブジェクトを返すだけ）"""
+    if not _trace["enabled"]:
+        return _NULL_SPAN
+    return Span(stage, attrs)
+
+def set_tracing(enabled):
+    _trace["enabled"] = bool(enabled)
+
+def tracing_enabled():
+    return _trace["enabled"]
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # Linux の ru_maxrss は KB 単位
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def write_trace(record):
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with _trace["lock"]:
+        os.makedirs(os.path.dirname(TRACE_FILE), exist_ok=True)
+        try:
+            if os.path.getsize(TRACE_FILE) > TRACE_MAX_BYTES:
+                os.replace(TRACE_FILE, TRACE_FILE + ".1")
+        except FileNotFoundError:
+            pass
+        # 1行ずつ追記モードで書く（レンダリングの子プロセスも同じファイルに書く）
+        with open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(line)
+
+def read_recent_traces(lines=TRACE_RECENT_LINES, path=TRACE_FILE):
+    """記録ファイルの末尾から直近 lines 件を読む"""
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - lines * 400))
+            tail = f.read().decode("utf-8", "replace").splitlines()
+    except FileNotFoundError:
+        return []
+    if size > lines * 400:
+        tail = tail[1:]   # 途中から読んだ最初の行は欠けている
+    records = []
+    for line in tail[-lines:]:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    return records
+
+def trace_percentiles(records):
+    """段階ごとの件数と、実時間・CPU 時間のパーセンタイル"""
+    by_stage = {}
+    for r in records:
+        by_stage.setdefault(r["stage"], []).append(r)
+    rows = []
+    for stage, rs in sorted(by_stage.items()):
+        wall = np.array([r["wall"] for r in rs])
+        cpu = np.array([r["cpu"] + r.get("child_cpu", 0) for r in rs])
+        p50, p90, p99 = (float(p) for p in np.percentile(wall, [50, 90, 99]))
+        rows.append({
+            "段階": stage, "件数": len(rs),
+            "p50(秒)": round(p50, 3), "p90(秒)": round(p90, 3), "p99(秒)": round(p99, 3),
+            "CPU p50(秒)": round(float(np.percentile(cpu, 50)), 3),
+            "最大メモリ(MB)": max((r.get("peak_rss_mb") or 0) for r in rs),
+            "失敗": sum(1 for r in rs if not r.get("ok", True)),
+        })
+    return rows
+
+@cache_resource(max_entries=1)
+def _trace_summary(path, size, mtime_ns):
+    return trace_percentiles(read_recent_traces(path=path))
+
+def trace_summary(path=TRACE_FILE):
+    """直近の記録の集計（記録ファイルのサイズと更新日時が変わらない限り集計し直さない）"""
+    if not os.path.exists(path):
+        return []
+    info = os.stat(path)
+    return _trace_summary(path, info.st_size, info.st_mtime_ns)
+
+# ★学習データの読み込み
+DATA_FILE = "learning_data.json"
+
+def load_data():
+    """起動時に学習データを読み込む"""
+    if os.path.exists(DATA_FILE):
+        try:
+            with open(DATA_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+                # styleがないデータには"通常"を自動補完
+                for item in data:
+                    if 'style' not in item:
+                        item['style'] = '通常'
+                return data
+        except Exception as e:
+            show_error(f"データ読み込みエラー: {e}")
+    
+    # デフォルトデータ
+    return [
+        {"odai": "目に入れても痛くない孫におじいちゃんがブチギレ。いったい何があった？", "ans": "おじいちゃんの入れ歯をメルカリで『ビンテージ雑貨』として出品していた", "style": "通常"},
+        {"odai": "この番組絶対ドッキリだろ！なぜ気付いた？", "ans": "通行人10人全員がよく見たらエキストラのバイト募集で見かけた顔だった", "style": "通常"},
+        {"odai": "ハゲてて良かった～なぜそう思った？", "ans": "職質のプロに『君、隠し事なさそうな頭してるね』とスルーされた", "style": "通常"},
+        {"odai": "ハゲてて良かった～なぜそう思った？", "ans": "美容師さんにお任せでと言ったら3秒で会計が終わった", "style": "通常"},
+        {"odai": "母親が私の友達に大激怒。いったい何があった？", "ans": "家族写真のお母さんの顔の部分だけに執拗に『ブサイクになるフィルター』をかけて保存した", "style": "通常"},
+        {"odai": "母親が私の友達に大激怒。いったい何があった？", "ans": "おばさんその服カーテンと同じ柄ですね！と明るく指摘した", "style": "通常"}
+    ]
+
+# --- 学習データの保存先：SQLite に1件ずつ書き込む（ファイル全体の書き直しをしない） ---
+LEARNING_DB = "learning_data.db"
+
+def example_key(odai, ans):
+    """(お題, 回答) の組の重複判定用ハッシュ"""
+    return hashlib.sha1(f"{odai}\0{ans}".encode("utf-8")).hexdigest()
+
+# --- 修正：傑作選は全件ではなく、お題に近いものだけをプロンプトに入れる ---
+FEW_SHOT_K = 8           # プロンプトに入れる傑作選の件数（データが増えても固定）
+NGRAM_SIZES = (2, 3)     # 類似度に使う文字 n-gram（日本語は単語分割せず文字単位で見る）
+
+def char_ngrams(text):
+    """文字 n-gram の出現回数"""
+    text = re.sub(r"\s+", "", text)
+    grams = {}
+    for n in NGRAM_SIZES:
+        for i in range(len(text) - n + 1):
+            g = text[i:i + n]
+            grams[g] = grams.get(g, 0) + 1
+    return grams
+
+class ExampleIndex:
+    """学習データの類似検索インデックス（文字 n-gram の BM25）
+
+    n-gram ごとの転置リストを持ち、1件の追加・削除はその例の n-gram 分だけ更新する。
+    検索はお題の n-gram に当たった例だけを採点するので、全件を舐めない。
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}   # n-gram -> {id: 出現数}
+        self.docs = {}       # id -> (n-gram 一覧, 長さ, style)
+        self.total_len = 0
+
+    def add(self, row):
+        self.remove(row["id"])
+        grams = char_ngrams(f"{row['odai']} {row['ans']}")
+        length = sum(grams.values())
+        for g, tf in grams.items():
+            self.postings.setdefault(g, {})[row["id"]] = tf
+        self.docs[row["id"]] = (tuple(grams), length, row.get("style", "通常"))
+        self.total_len += length
+
+    def remove(self, example_id):
+        doc = self.docs.pop(example_id, None)
+        if doc is None:
+            return
+        grams, length, _ = doc
+        for g in grams:
+            posting = self.postings[g]
+            del posting[example_id]
+            if not posting:
+                del self.postings[g]
+        self.total_len -= length
+
+    def candidates(self, text):
+        """text（空白を除いたもの）を部分文字列として含みうる例の id（短すぎて絞れないときは None）
+
+        text の n-gram をすべて含む例だけに絞る。実際に含むかどうかは呼び出し側で確かめる。
+        """
+        n = min(NGRAM_SIZES)
+        if len(text) < n:
+            return None
+        grams = sorted({text[i:i + n] for i in range(len(text) - n + 1)}, key=lambda g: len(self.postings.get(g, ())))
+        ids = set(self.postings.get(grams[0], ()))
+        for g in grams[1:]:
+            if not ids:
+                break
+            ids &= self.postings.get(g, {}).keys()
+        return ids
+
+    def style_of(self, example_id):
+        return self.docs[example_id][2]
+
+    def search(self, query, k, style=None):
+        """query に近い順に最大 k 件の id を返す（style 指定時はその種別だけ）"""
+        n_docs = len(self.docs)
+        if not n_docs:
+            return []
+        avg_len = self.total_len / n_docs
+        scores = {}
+        for g in char_ngrams(query):
+            posting = self.postings.get(g)
+            if not posting:
+                continue
+            idf = np.log1p((n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for example_id, tf in posting.items():
+                _, length, doc_style = self.docs[example_id]
+                if style is not None and doc_style != style:
+                    continue
+                denom = tf + self.k1 * (1 - self.b + self.b * length / avg_len)
+                scores[example_id] = scores.get(example_id, 0.0) + idf * tf * (self.k1 + 1) / denom
+        # 同点は新しい例を優先
+        return sorted(scores, key=lambda i: (-scores[i], -i))[:k]
+
+# --- インポート：ファイル全体を読み込まず、1件ずつ読んで検証し、まとめて書き込む ---
+STYLES = ["通常", "知的", "ブラック"]
+IMPORT_BATCH_SIZE = 1000      # 1トランザクションで書き込む件数
+IMPORT_CHUNK_SIZE = 64 * 1024 # ファイルから一度に読む文字数
+IMPORT_MAX_RECORD_SIZE = 1024 * 1024 # 1件（JSONL なら1行）の最大文字数
+
+def iter_json_records(f, chunk_size=IMPORT_CHUNK_SIZE, max_record_size=IMPORT_MAX_RECORD_SIZE):
+    """JSON 配列（エクスポート形式）か JSONL を先頭から1件ずつ読む
+
+    f はファイルオブジェクト（バイナリなら UTF-8 として少しずつデコードする）。
+    バッファに持つのは読みかけの1件分（JSONL なら1行分）だけなので、ファイルがどれだけ大きくてもメモリ使用量は増えない。
+    壊れた JSON や、max_record_size 文字を超えても1件が読み終わらないときは ValueError。
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def read(size):
+        while True:
+            data = f.read(size)
+            if not isinstance(data, bytes):
+                return data
+            # 多バイト文字の途中で切れて何も出てこなかったときは続きを読む
+            text = text_decoder.decode(data, final=not data)
+            if text or not data:
+                return text
+
+    def fill():
+        nonlocal buf, pos, eof
+        # 壊れた JSON で1件が終わらないときに、ファイルの終わりまで読み込まないようにする
+        if len(buf) - pos > max_record_size:
+            raise ValueError(f"1件が {max_record_size} 文字を超えています（JSON が壊れている可能性があります）")
+        chunk = read(chunk_size)
+        buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+
+    def peek():
+        """空白を飛ばした次の1文字（終わりなら空文字）"""
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf[pos] if pos < len(buf) else ""
+            fill()
+
+    # 先頭が [ なら配列、それ以外は1行1件（JSONL）として読む
+    if peek() != "[":
+        # JSONL は行に区切ってから読む（バッファの端で切れた数値などを、途中までで1件と読まないように）
+        scanned = pos
+        while True:
+            nl = buf.find("\n", scanned)
+            if nl < 0 and not eof:
+                scanned = len(buf) - pos
+                fill()
+                continue
+            line = buf[pos:] if nl < 0 else buf[pos:nl]
+            pos = len(buf) if nl < 0 else nl + 1
+            scanned = pos
+            if line.strip():
+                yield json.loads(line)
+            if nl < 0:
+                return
+
+    pos += 1
+    if peek() == "]":
+        pos += 1
+    else:
+        while True:
+            if peek() == "":
+                raise ValueError("JSON 配列が閉じられていません")
+            while True:
+                try:
+                    record, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    # 1件が読みかけで切れているので、続きを読んでからやり直す
+                    fill()
+                    continue
+                if end < len(buf) or eof:
+                    break
+                # バッファの端までで読めた値は数値の途中かもしれないので、続きを読んで確かめる
+                fill()
+            pos = end
+            yield record
+            c = peek()
+            if c == ",":
+                pos += 1
+            elif c == "]":
+                pos += 1
+                break
+            elif c == "":
+                raise ValueError("JSON 配列が閉じられていません")
+            else:
+                raise ValueError("JSON 配列の要素の間には , が必要です")
+    if peek():
+        raise ValueError("JSON 配列の後ろに余分なデータがあります")
+
+def normalize_record(item):
+    """インポートする1件を検証して {"odai", "ans", "style"} にそろえる（使えない行は None）"""
+    if not isinstance(item, dict):
+        return None
+    odai, ans = item.get("odai"), item.get("ans")
+    if not isinstance(odai, str) or not isinstance(ans, str) or not odai.strip() or not ans.strip():
+        return None
+    # styleがないデータには"通常"を自動補完
+    style = item.get("style") or "通常"
+    if style not in STYLES:
+        return None
+    return {"odai": odai, "ans": ans, "style": style}
+
+def scan_import(f):
+    """インポート前の下見：(使える件数, 使えない件数) を数える（壊れた JSON は ValueError）"""
+    valid = invalid = 0
+    for item in iter_json_records(f):
+        if normalize_record(item) is None:
+            invalid += 1
+        else:
+            valid += 1
+    return valid, invalid
+
+class LearningStore:
+    """学習データのストア
+
+    追加・更新・削除は id 指定で1件ずつ行い、(お題, 回答) の組は一意インデックスで重複を弾く。
+    一覧はプロセス内にキャッシュして全セッションで共有し、DB のバージョン番号が
+    自分の知らない値に変わったとき（別プロセスが書き込んだとき）だけ読み直す。
+    """
+
+    def __init__(self, path=LEARNING_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._rows = None          # id -> {"id", "odai", "ans", "style"}
+        self._list = None
+        self._version = None
+        self._index = ExampleIndex()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            fresh = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'meta'").fetchone()[0] == 0
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS examples ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " odai TEXT NOT NULL, ans TEXT NOT NULL, style TEXT NOT NULL DEFAULT '通常',"
+                " key TEXT NOT NULL UNIQUE)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('version', 0)")
+            # 取り込み済みの印。この印ができる前からある DB は、作ったときに取り込み済みなので 1 にする
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('migrated', ?)", (0 if fresh else 1,))
+            migrated = conn.execute("SELECT value FROM meta WHERE name = 'migrated'").fetchone()[0]
+        if not migrated:
+            # 初回だけ従来の learning_data.json（なければデフォルトデータ）を取り込む。
+            # あとで全件消しても、起動し直すたびに取り込み直すことはない
+            self.add_many(load_data())
+            with self._connect() as conn:
+                conn.execute("UPDATE meta SET value = 1 WHERE name = 'migrated'")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _db_version(self, conn):
+        return conn.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()[0]
+
+    def _write(self, apply_sql, apply_cache):
+        """書き込みを1トランザクションで行い、バージョン番号を進める
+
+        書き込み前のバージョンがキャッシュと同じなら（他から書かれていなければ）
+        キャッシュにも同じ変更を当てて、一覧の読み直しを省く。
+        """
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                before = self._db_version(conn)
+                result = apply_sql(conn)
+                conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'version'")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            finally:
+                conn.close()
+            if self._rows is not None and self._version == before:
+                apply_cache(result)
+                self._version = before + 1
+                self._list = None
+            else:
+                self._version = None   # 次の all() で DB と突き合わせる
+            return result
+
+    def _put(self, row):
+        self._rows[row["id"]] = row
+        self._index.add(row)
+
+    def _drop(self, example_id):
+        self._rows.pop(example_id, None)
+        self._index.remove(example_id)
+
+    def all(self):
+        """全件のリスト（共有キャッシュなので書き換えないこと）"""
+        with self._lock:
+            conn = self._connect()
+            try:
+                version = self._db_version(conn)
+                if self._rows is None or version != self._version:
+                    rows = conn.execute("SELECT id, odai, ans, style FROM examples ORDER BY id").fetchall()
+                    self._sync(OrderedDict((r["id"], dict(r)) for r in rows))
+                    self._version = version
+                    self._list = None
+            finally:
+                conn.close()
+            if self._list is None:
+                self._list = list(self._rows.values())
+            return self._list
+
+    def _sync(self, rows):
+        """DB から読んだ全件と突き合わせ、変わった行だけインデックスを更新する"""
+        if self._rows is None:
+            self._rows = OrderedDict()
+        for example_id in list(self._rows):
+            if rows.get(example_id) != self._rows[example_id]:
+                self._drop(example_id)
+        for example_id, row in rows.items():
+            if example_id not in self._rows:
+                self._put(row)
+        self._rows = rows
+
+    def similar(self, query, k=FEW_SHOT_K, style=None):
+        """お題に近い例を k 件返す
+
+        style が同じ例を優先し、足りなければほかの種別、それでも足りなければ新しい例で埋める。
+        """
+        rows = self.all()
+        with self._lock:
+            ids = self._index.search(query, k, style) if style is not None else []
+            if len(ids) < k:
+                ids += [i for i in self._index.search(query, k) if i not in ids][:k - len(ids)]
+            picked = [self._rows[i] for i in ids if i in self._rows]
+        if len(picked) < k:
+            chosen = set(ids)
+            picked += [r for r in reversed(rows) if r["id"] not in chosen][:k - len(picked)]
+        return picked
+
+    def find(self, query="", style=None, offset=0, limit=20):
+        """お題か回答に query を含む例を新しい順に探す（編集画面のページ送り用）
+
+        戻り値は (該当件数, offset 件目から limit 件のリスト)。空白は無視して比べ、style 指定時はその種別だけ。
+        n-gram の転置リストで候補を絞ってから確かめるので、全件の文字列は舐めない。
+        """
+        self.all()
+        text = re.sub(r"\s+", "", query)
+        with self._lock:
+            ids = self._index.candidates(text) if text else None
+            ids = reversed(self._rows) if ids is None else sorted(ids, reverse=True)
+            hits = []
+            for example_id in ids:
+                if style is not None and self._index.style_of(example_id) != style:
+                    continue
+                row = self._rows[example_id]
+                if text and not self._contains(row, text):
+                    continue
+                hits.append(row)
+        return len(hits), hits[offset:offset + limit]
+
+    @staticmethod
+    def _contains(row, text):
+        if text in row["odai"] or text in row["ans"]:
+            return True
+        # 1文字なら空白をまたぐことはないので、空白を除いて比べ直すまでもない
+        return len(text) > 1 and (text in re.sub(r"\s+", "", row["odai"]) or text in re.sub(r"\s+", "", row["ans"]))
+
+    def get(self, example_id):
+        self.all()
+        with self._lock:
+            return self._rows.get(example_id)
+
+    def export_json(self):
+        """エクスポート用の JSON 文字列（id は含めない・インポートでそのまま読める形）"""
+        return json.dumps(
+            [{"odai": ex["odai"], "ans": ex["ans"], "style": ex["style"]} for ex in self.all()],
+            ensure_ascii=False, indent=2
+        )
+
+    def exists(self, odai, ans):
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM examples WHERE key = ?", (example_key(odai, ans),)).fetchone() is not None
+
+    def add(self, odai, ans, style="通常"):
+        """1件追加して id を返す（重複なら None）"""
+        def sql(conn):
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO examples (odai, ans, style, key) VALUES (?, ?, ?, ?)",
+                (odai, ans, style, example_key(odai, ans)),
+            )
+            return cur.lastrowid if cur.rowcount else None
+        def cache(new_id):
+            if new_id is not None:
+                self._put({"id": new_id, "odai": odai, "ans": ans, "style": style})
+        return self._write(sql, cache)
+
+    def add_many(self, items, clear=False):
+        """まとめて追加して、追加できた件数を返す（重複は自動で除外・clear なら先に全件消す）"""
+        def sql(conn):
+            if clear:
+                conn.execute("DELETE FROM examples")
+            added = []
+            for item in items:
+                style = item.get("style") or "通常"
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO examples (odai, ans, style, key) VALUES (?, ?, ?, ?)",
+                    (item["odai"], item["ans"], style, example_key(item["odai"], item["ans"])),
+                )
+                if cur.rowcount:
+                    added.append({"id": cur.lastrowid, "odai": item["odai"], "ans": item["ans"], "style": style})
+            return added
+        def cache(added):
+            if clear:
+                self._rows.clear()
+                self._index = ExampleIndex()
+            for row in added:
+                self._put(row)
+        return len(self._write(sql, cache))
+
+    def import_records(self, records, replace=False, batch_size=IMPORT_BATCH_SIZE, progress=None):
+        """iter_json_records などから流れてくる行を検証しながら取り込む
+
+        batch_size 件ごとに1トランザクションで書き込むので、手元に持つのは1バッチ分だけ。
+        重複（既存データとも、ファイル内同士とも）は (お題, 回答) の一意インデックスで除外する。
+        replace なら最初のバッチで既存データを消す。progress があれば (読んだ件数) を知らせる。
+        戻り値は {"added": 追加件数, "duplicates": 重複件数, "invalid": 使えなかった件数}。
+        """
+        counts = {"added": 0, "duplicates": 0, "invalid": 0}
+        batch = []
+        seen = 0
+        clear = replace
+
+        def flush():
+            nonlocal clear
+            added = self.add_many(batch, clear=clear)
+            counts["added"] += added
+            counts["duplicates"] += len(batch) - added
+            clear = False
+            batch.clear()
+            if progress: progress(seen)
+
+        for item in records:
+            seen += 1
+            row = normalize_record(item)
+            if row is None:
+                counts["invalid"] += 1
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                flush()
+        if batch or clear:
+            flush()
+        return counts
+
+    def update(self, example_id, ans=None, style=None):
+        """回答・種別を更新する（更新後の組がほかと重複するなら False）"""
+        row = self.get(example_id)
+        if row is None:
+            return False
+        new = dict(row, ans=row["ans"] if ans is None else ans, style=row["style"] if style is None else style)
+        def sql(conn):
+            try:
+                conn.execute(
+                    "UPDATE examples SET ans = ?, style = ?, key = ? WHERE id = ?",
+                    (new["ans"], new["style"], example_key(new["odai"], new["ans"]), example_id),
+                )
+            except sqlite3.IntegrityError:
+                return False
+            return True
+        def cache(ok):
+            if ok: self._put(new)
+        return self._write(sql, cache)
+
+    def delete(self, example_id):
+        def sql(conn):
+            conn.execute("DELETE FROM examples WHERE id = ?", (example_id,))
+        def cache(_):
+            self._drop(example_id)
+        self._write(sql, cache)
+
+    def replace_all(self, items):
+        """全件を入れ替えて、入った件数を返す（削除と追加は同じトランザクション）"""
+        return self.add_many(items, clear=True)
+
+@cache_resource
+def get_learning_store():
+    """全セッションで共有する学習データストア"""
+    return LearningStore()
+
+# --- 3. ロジック ---
+
+async def save_edge_voice(text, filename, voice_name, rate="+20%"):
+    import edge_tts
+    communicate = edge_tts.Communicate(text, voice_name, rate=rate)
+    await communicate.save(filename)
+
+# --- 音声合成キャッシュ：同じ断片はネットに取りに行かずディスクから読む ---
+TTS_CACHE_DIR = os.path.join("cache", "tts")
+TTS_CACHE_MAX_BYTES = 500 * 1024 * 1024
+EDGE_VOICE = "ja-JP-KeitaNeural"
+EDGE_RATE = "+15%"
+
+def prune_cache_dir(directory, max_bytes, keep=()):
+    """ディレクトリの合計サイズが上限を超えたら、最後に使われたのが古いファイルから消す（keep のファイルは消さない）"""
+    keep = {os.path.abspath(p) for p in keep}
+    entries = []
+    total = 0
+    with os.scandir(directory) as it:
+        for e in it:
+            # 書き込み途中のファイルには触らない
+            if not e.is_file() or ".part" in e.name: continue
+            info = e.stat()
+            entries.append((info.st_mtime, info.st_size, e.path))
+            total += info.st_size
+    if total <= max_bytes: return
+    for _, size, path in sorted(entries):
+        if os.path.abspath(path) in keep: continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        total -= size
+        if total <= max_bytes: break
+
+def tts_cache_path(text, mode):
+    """(断片テキスト, エンジン, 声, 速さ) のハッシュで決まるキャッシュファイル名"""
+    voice, rate = ("ja", "") if mode == "gtts" else (EDGE_VOICE, EDGE_RATE)
+    raw = json.dumps([text, mode, voice, rate], ensure_ascii=False)
+    return os.path.join(TTS_CACHE_DIR, hashlib.sha256(raw.encode("utf-8")).hexdigest() + ".mp3")
+
+# 同時に合成する断片の上限（TTS サービスに一度に投げすぎないため）
+TTS_CONCURRENCY = 4
+
+def _synthesize_gtts(text, path):
+    # 同時に別セッションが同じ断片を作っても衝突しないよう、一意な名前に書いてから置き換える
+    tmp = f"{path}.{uuid.uuid4().hex}.part.mp3"
+    try:
+        with span("tts", engine="gtts", chars=len(text)):
+            tts = gTTS(text, lang='ja')
+            tts.save(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+async def _synthesize_edge(text, path, sem):
+    async with sem:
+        tmp = f"{path}.{uuid.uuid4().hex}.part.mp3"
+        try:
+            with span("tts", engine="edge", chars=len(text)):
+                await save_edge_voice(text, tmp, EDGE_VOICE, rate=EDGE_RATE)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+async def _synthesize_edge_all(jobs, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+    await asyncio.gather(*[_synthesize_edge(text, path, sem) for text, path in jobs])
+
+def synthesize_fragments(texts, mode, concurrency=TTS_CONCURRENCY):
+    """断片のリストを音声ファイルにしてパスのリストを返す
+
+    キャッシュにない断片だけを同時に合成する。edge-tts は1つのイベントループで gather、
+    gTTS はスレッドプールで、どちらも concurrency 個までに抑える。
+    """
+    paths = [tts_cache_path(t, mode) for t in texts]
+    misses = {}
+    for text, path in zip(texts, paths):
+        if os.path.exists(path):
+            # 使ったことを更新日時で記録（LRU での破棄順に使う）
+            os.utime(path, None)
+        else:
+            misses[path] = text
+    if not misses:
+        return paths
+
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    jobs = [(text, path) for path, text in misses.items()]
+    if mode == "gtts":
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(jobs)))) as pool:
+            list(pool.map(lambda job: _synthesize_gtts(*job), jobs))
+    else:
+        asyncio.run(_synthesize_edge_all(jobs, max(1, concurrency)))
+    prune_cache_dir(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES, keep=paths)
+    return paths
+
+def synthesize_fragment(text, mode):
+    """1つの断片を音声ファイルにしてそのパスを返す（キャッシュにあれば合成しない）"""
+    return synthesize_fragments([text], mode)[0]
+
+def split_audio_text(full_text):
+    """読みを「_」の区切りで、発音する断片と無音のタメに分ける"""
+    return [part for part in re.split(r'(_+)', full_text) if part]
+
+def prefetch_tts(full_text, mode, concurrency=TTS_CONCURRENCY):
+    """読みに含まれる断片を先に合成してキャッシュに入れておく"""
+    texts = [part for part in split_audio_text(full_text) if '_' not in part]
+    return synthesize_fragments(texts, mode, concurrency)
+
+def decode_audio(path):
+    """音声ファイルを (サンプル数, 2) の float32 配列にデコードする"""
+    proc = subprocess.run(
+        [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-i", path,
+         "-f", "f32le", "-ac", "2", "-ar", str(AUDIO_FPS), "-"],
+        capture_output=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"音声デコード失敗: {path}: {proc.stderr.decode('utf-8', 'replace')[-300:]}")
+    return np.frombuffer(proc.stdout, dtype=np.float32).reshape(-1, 2)
+
+def write_wav(path, samples):
+    """float32 の音声配列を 16bit の wav に書き出す"""
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2")
+    with wave.open(path, "wb") as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(AUDIO_FPS)
+        w.writeframes(pcm.tobytes())
+
+def read_wav(path):
+    """write_wav で書いた wav を float32 の音声配列に戻す"""
+    with wave.open(path, "rb") as w:
+        pcm = np.frombuffer(w.readframes(w.getnframes()), dtype="<i2")
+    return (pcm.astype(np.float32) / 32767).reshape(-1, 2)
+
+def build_voice_array(full_text, mode="gtts", concurrency=TTS_CONCURRENCY):
+    """読みを音声配列にする（断片は1回ずつデコードし、タメはゼロで埋めて連結）"""
+    parts = split_audio_text(full_text)
+    # 発音する断片はまとめて同時に合成しておく
+    voiced = iter(prefetch_tts(full_text, mode, concurrency))
+    chunks = []
+    for part in parts:
+        if '_' in part:
+            # --- 修正：0.1 を 0.06 に変更 ---
+            duration = len(part) * 0.06
+            chunks.append(np.zeros((int(round(duration * AUDIO_FPS)), 2), dtype=np.float32))
+        else:
+            chunks.append(decode_audio(next(voiced)))
+    if not chunks: return None
+    return np.concatenate(chunks)
+
+def build_controlled_audio(full_text, mode="gtts", concurrency=TTS_CONCURRENCY):
+    """読みを moviepy の音声クリップにする（中身は build_voice_array）"""
+    samples = build_voice_array(full_text, mode, concurrency)
+    if samples is None: return None
+    from moviepy.audio.AudioClip import AudioArrayClip
+    return AudioArrayClip(samples, fps=AUDIO_FPS)
+
+# --- 音声のミックス：効果音の下地はプロセスごとに1回だけ作り、声を足し込むだけにする ---
+ODAI_VOICE_START = 2.5
+ANS_VOICE_START = 10.5
+
+def mix_into(buf, samples, start):
+    """buf の start 秒の位置から samples を足し込む（はみ出した分は捨てる）"""
+    i = int(round(start * AUDIO_FPS))
+    if i >= len(buf): return
+    n = min(len(samples), len(buf) - i)
+    buf[i:i + n] += samples[:n]
+
+@cache_resource
+def _load_bgm_bed(duration, signature):
+    # 呪いを解く「絶対固定」のロジック
+    # normalizeは素材に依存して計算がブレるため、あえて削除。
+    # 直接、数値で叩く。これが最も「計算ミス」が起きない形です。
+    bed = np.zeros((int(round(duration * AUDIO_FPS)), 2), dtype=np.float32)
+    mix_into(bed, decode_audio(SOUND1) * 0.03, 0.8)
+    mix_into(bed, decode_audio(SOUND2) * 0.2, 9.0)
+    bed.setflags(write=False)
+    return bed
+
+def bgm_bed(duration):
+    """効果音（SOUND1/SOUND2）だけを音量調整して敷いたタイムライン（素材が差し替えられたら作り直す）"""
+    signature = tuple((p, os.stat(p).st_mtime_ns) for p in (SOUND1, SOUND2))
+    return _load_bgm_bed(duration, signature)
+
+def mix_timeline(duration, odai_voice=None, ans_voice=None):
+    """タイムライン全体（0〜duration 秒）の音声を、確保済みのバッファへの足し込みだけで作る"""
+    buf = bgm_bed(duration).copy()
+    if odai_voice is not None: mix_into(buf, odai_voice, ODAI_VOICE_START)
+    if ans_voice is not None: mix_into(buf, ans_voice, ANS_VOICE_START)
+    np.clip(buf, -1.0, 1.0, out=buf)
+    return buf
+
+def segment_audio(audio, seg_start, seg_end):
+    """タイムラインの音声から区間 [seg_start, seg_end) を切り出す（足りない分は無音）"""
+    a, b = int(round(seg_start * AUDIO_FPS)), int(round(seg_end * AUDIO_FPS))
+    seg = audio[a:b]
+    if len(seg) < b - a:
+        seg = np.concatenate([seg, np.zeros((b - a - len(seg), 2), dtype=np.float32)])
+    return np.ascontiguousarray(seg, dtype=np.float32)
+
+# --- フォントとテロップ画像のキャッシュ ---
+# Streamlit はボタン操作のたびにスクリプトを頭から実行し直すので、
+# st.cache_resource に載せて再実行・セッションをまたいでプロセス内で共有する
+TEXT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+@cache_resource
+def load_font(path, size):
+    """フォントは (パス, サイズ) ごとに1回だけ読み込む"""
+    try: 
+        return ImageFont.truetype(path, size)
+    except: 
+        return ImageFont.load_default()
+
+@cache_resource
+def get_text_cache():
+    """テロップ画像キャッシュの本体（容量上限つきLRU）"""
+    return {
+        "lock": threading.Lock(),
+        "entries": OrderedDict(),
+        "bytes": 0,
+        "stats": {"hits": 0, "misses": 0, "evictions": 0},
+    }
+
+def text_cache_stats():
+    """テロップ画像キャッシュのヒット数・ミス数・使用量"""
+    cache = get_text_cache()
+    with cache["lock"]:
+        return dict(cache["stats"], entries=len(cache["entries"]), bytes=cache["bytes"])
+
+# --- 修正：引数に canvas_size を追加し、サイズを可変にする ---
+# --- 修正：キャンバス全体ではなく、文字が乗っている範囲だけを切り出して返す ---
+def create_text_image(text, fontsize, color, pos, canvas_size=(1920, 1080)):
+    """テキストを描いた RGBA 画像と、キャンバス上の貼り付け位置 (x, y) を返す
+
+    画像は文字の範囲（キャンバス内に収まる部分）だけなので、合成時のブレンドもその範囲だけで済む。
+    同じ引数の画像はメモリ上のキャッシュから返すので、受け取った画像は書き換えないこと。
+    """
+    cache = get_text_cache()
+    key = (FONT_PATH, text, fontsize, color, tuple(pos), tuple(canvas_size))
+    with cache["lock"]:
+        hit = cache["entries"].get(key)
+        if hit is not None:
+            cache["entries"].move_to_end(key)
+            cache["stats"]["hits"] += 1
+            return hit
+        cache["stats"]["misses"] += 1
+
+    with span("text_image", chars=len(text), fontsize=fontsize):
+        img, offset = render_text_image(text, fontsize, color, pos, canvas_size)
+    img.setflags(write=False)
+    result = (img, offset)
+
+    with cache["lock"]:
+        if key not in cache["entries"]:
+            cache["entries"][key] = result
+            cache["bytes"] += img.nbytes
+        # 容量を超えたら古いものから捨てる
+        while cache["bytes"] > TEXT_CACHE_MAX_BYTES and len(cache["entries"]) > 1:
+            _, (old_img, _) = cache["entries"].popitem(last=False)
+            cache["bytes"] -= old_img.nbytes
+            cache["stats"]["evictions"] += 1
+    return result
+
+def render_text_image(text, fontsize, color, pos, canvas_size):
+    """create_text_image の実体（キャッシュなし）"""
+    font = load_font(FONT_PATH, fontsize)
+    measure = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    
+    clean_display = text.replace("_", "")
+    display_text = clean_display.replace("　", "\n").replace(" ", "\n")
+    lines = [l for l in display_text.split("\n") if l.strip()]
+    if not lines: lines = [" "]
+    
+    line_spacing = 15
+    # 1行につき textbbox は1回だけ測る
+    bboxes = [measure.textbbox((0, 0), line, font=font) for line in lines]
+    line_heights = [b[3] - b[1] for b in bboxes]
+    total_height = sum(line_heights) + (len(lines) - 1) * line_spacing
+    
+    # 各行の描画位置（キャンバス座標）と、実際に文字が乗る範囲を先に決める
+    placements = []
+    boxes = []
+    current_y = pos[1] - total_height // 2
+    for line, bbox, line_h in zip(lines, bboxes, line_heights):
+        x = pos[0] - (bbox[2] - bbox[0]) // 2
+        placements.append((x, current_y, line))
+        boxes.append((bbox[0] + x, bbox[1] + current_y, bbox[2] + x, bbox[3] + current_y))
+        current_y += line_h + line_spacing
+
+    # 文字の範囲をキャンバス内に収めて切り出す
+    left = max(0, min(b[0] for b in boxes))
+    top = max(0, min(b[1] for b in boxes))
+    right = min(canvas_size[0], max(b[2] for b in boxes))
+    bottom = min(canvas_size[1], max(b[3] for b in boxes))
+    if right <= left or bottom <= top:
+        # 描くものがない場合は透明な1ピクセル
+        left, top, right, bottom = 0, 0, 1, 1
+
+    img = Image.new("RGBA", (right - left, bottom - top), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(img)
+    for x, y, line in placements:
+        draw.text((x - left, y - top), line, font=font, fill=color)
+    
+    return np.array(img), (left, top)
+
+# --- 修正後：引数に video_mode を追加し、縦横の設定を分岐 ---
+# --- 一括生成対応：お題ごとの共通処理と回答ごとの処理を分離 ---
+
+# 一括生成で同時に走らせるレンダリングプロセス数
+RENDER_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+# タイムライン：0〜10秒がお題パート（全回答で共通）、10秒以降が回答パート
+INTRO_END = 10.0
+INTRO_CACHE_DIR = os.path.join("cache", "intro")
+INTRO_CACHE_MAX_BYTES = int(os.environ.get("OOGIRI_INTRO_CACHE_MB", "1024")) * 1024 * 1024
+
+# 合成バックエンド："moviepy"（従来どおり Python で1フレームずつ合成）/ "ffmpeg"（フィルタグラフで一括合成）
+RENDER_BACKENDS = ["moviepy", "ffmpeg"]
+RENDER_BACKEND = os.environ.get("OOGIRI_RENDER_BACKEND", "moviepy")
+
+# エンコード設定：名前つきのプロファイル。final は従来どおりの画質（libx264 の既定値と同じ preset/crf）、
+# preview は解像度・fps を落として速さ優先（タイミングや文字の収まりを確認する用）
+ENCODE_PROFILES = {
+    "final": {"label": "最終書き出し", "scale": 1.0, "fps": 24, "preset": "medium", "crf": 23},
+    "preview": {"label": "プレビュー", "scale": 0.5, "fps": 12, "preset": "ultrafast", "crf": 30},
+}
+# OOGIRI_ENCODE_PROFILES に JSON（例: {"preview": {"scale": 0.33}}）を入れると、追加・上書きできる
+for _name, _overrides in json.loads(os.environ.get("OOGIRI_ENCODE_PROFILES", "{}")).items():
+    ENCODE_PROFILES[_name] = dict(ENCODE_PROFILES.get(_name, ENCODE_PROFILES["final"]), **_overrides)
+DEFAULT_PROFILE = "final"
+
+def encode_size(size, profile):
+    """プロファイルの倍率をかけた出力サイズ（libx264 のため偶数にそろえる）"""
+    scale = ENCODE_PROFILES[profile]["scale"]
+    return tuple(max(2, int(round(v * scale / 2)) * 2) for v in size)
+
+def get_layout(video_mode):
+    """形式に応じたレイアウト設定（100%制御）"""
+    if video_mode == "縦動画 (9:16)":
+        # 縦動画用の配置（中央付近にレイアウト）
+        return {
+            "target_size": (1080, 1920),
+            "template": "template_v.mp4",
+            "pos_odai_main": (540, 850),   # お題（メイン）
+            "pos_odai_sub": (540, 500),    # お題（サブ・上部）
+            "pos_ans": (540, 850),         # 回答（中央やや下）
+        }
+    # ★横動画の設定（今までの位置を維持）
+    return {
+        "target_size": (1920, 1080),
+        "template": BASE_VIDEO,
+        "pos_odai_main": (960, 530),
+        "pos_odai_sub": (880, 300),
+        "pos_ans": (960, 500),
+    }
+
+def clean_answer_text(text):
+    """回答の先頭に残った番号や記号を取り除く"""
+    return re.sub(r'^[0-9０-９\.\s、。・＊\*]+', '', text).strip()
+
+def odai_font_sizes(odai_display):
+    """お題（メイン：i1）とお題サブ（i2）のフォントサイズを文字数から決める"""
+    odai_len = len(odai_display)
+    # 1. お題（メイン：i1）のサイズ調整
+    if odai_len <= 10:
+        main_size = 120
+    elif odai_len <= 20:
+        main_size = 100
+    elif odai_len <= 30:
+        main_size = 80
+    else:
+        main_size = 65
+
+    # 2. お題サブ (i2: 背景パネル用) のサイズ
+    # 150から、パネルにちょうど収まる「100」前後に戻します
+    if odai_len <= 10:
+        sub_size = 120
+    elif odai_len <= 20:
+        sub_size = 100
+    else:
+        sub_size = 80
+    return main_size, sub_size
+
+def ans_font_size(clean_ans_disp):
+    """回答（i3）のフォントサイズを文字数から決める"""
+    ans_len = len(clean_ans_disp)
+    if ans_len <= 10:
+        return 120
+    elif ans_len <= 20:
+        return 100
+    return 80
+
+def intro_cache_key(odai_display, odai_audio, video_mode, template, backend, profile=DEFAULT_PROFILE):
+    """お題パートのキャッシュキー（テンプレート・効果音・フォント・エンコード設定が変わったら別のキーになる）"""
+    stat = os.stat(template)
+    raw = json.dumps([RENDER_VERSION, odai_display, odai_audio, video_mode, template, stat.st_size, stat.st_mtime_ns,
+                      file_digest(SOUND1), file_digest(SOUND2), FONT_PATH, file_digest(FONT_PATH), backend,
+                      profile, ENCODE_PROFILES[profile]], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def run_ffmpeg(args, input=None):
+    """ffmpeg を直接実行する（失敗時はエラー出力の末尾を例外に載せる）"""
+    cmd = [FFMPEG_BIN, "-y", "-hide_banner", "-loglevel", "error"] + args
+    proc = subprocess.run(cmd, input=input, capture_output=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg 失敗: {proc.stderr.decode('utf-8', 'replace')[-500:]}")
+
+def concat_segments(paths, out, audio=None):
+    """同じ設定でエンコードした動画同士をストリームコピーで連結する（映像は再エンコードしない）
+
+    audio（タイムライン全体の音声）を渡すと、映像だけを連結して音声はこれを1回でエンコードして付ける。
+    区間ごとの AAC をつなぐと継ぎ目ごとに先頭の無音（priming）がずれて残るので、音ズレを出さないためにこちらを使う。
+    """
+    list_file = f"{out}.txt"
+    with open(list_file, "w", encoding="utf-8") as f:
+        for p in paths:
+            f.write(f"file '{os.path.abspath(p)}'\n")
+    try:
+        with span("concat"):
+            if audio is None:
+                run_ffmpeg(["-f", "concat", "-safe", "0", "-i", list_file, "-c", "copy", "-movflags", "+faststart", out])
+            else:
+                run_ffmpeg([
+                    "-f", "concat", "-safe", "0", "-i", list_file,
+                    "-f", "f32le", "-ar", str(AUDIO_FPS), "-ac", "2", "-i", "pipe:0",
+                    "-map", "0:v", "-map", "1:a", "-c:v", "copy", "-c:a", "aac", "-ar", str(AUDIO_FPS),
+                    "-movflags", "+faststart", out,
+                ], input=np.ascontiguousarray(audio, dtype=np.float32).tobytes())
+    finally:
+        os.remove(list_file)
+
+def media_duration(path):
+    """音声・動画ファイルの長さ（秒）"""
+    return ffmpeg_parse_infos(path)["duration"]
+
+# --- テンプレートのコマのキャッシュ：区間ごとに1回だけデコードして生の RGB をファイルに置き、memmap で読む ---
+# ファイル名はテンプレートの中身のハッシュで決まるので、差し替えられたら自動的に別のファイルになる。
+# ページキャッシュを介して共有されるので、バッチのワーカープロセスはデコードせずにコピーなしで読める。
+# 生の RGB を GB 単位で書き出すぶん、作るのは1回デコードして読むより重いので、同じ区間を何度も読む
+# バッチ（render_geki_videos_batch）が前もって作り、1本だけのレンダリングはあるときだけ使う。
+FRAME_CACHE_DIR = os.path.join("cache", "frames")
+FRAME_CACHE_MAX_BYTES = int(os.environ.get("OOGIRI_FRAME_CACHE_MB", "4096")) * 1024 * 1024
+# 1080x1920 のテンプレートで、作るのは1回デコードするより約6秒重く、1本あたり約2秒浮く。元が取れる本数
+FRAME_CACHE_MIN_ANSWERS = int(os.environ.get("OOGIRI_FRAME_CACHE_MIN_ANSWERS", "4"))
+
+def use_frame_cache(count, profile):
+    """count 本のバッチでコマのキャッシュを前もって作るか
+    縮小して書き出す設定（プレビュー）は全解像度・元の fps のコマを書き出す割に合わないので作らない
+    """
+    return count >= FRAME_CACHE_MIN_ANSWERS and ENCODE_PROFILES[profile]["scale"] >= 1
+
+@cache_resource
+def _template_info(template, digest):
+    info = ffmpeg_parse_infos(template)
+    return info["duration"], tuple(info["video_size"]), info["video_fps"]
+
+@cache_resource(max_entries=8)
+def _open_frames(path, shape):
+    return np.memmap(path, dtype=np.uint8, mode="r", shape=shape)
+
+def template_frames(template, seg_start, seg_end, create=True):
+    """テンプレートの区間 [seg_start, seg_end) の全コマ（元の fps のまま）を (枚数, 高さ, 幅, 3) の memmap と fps で返す
+
+    create が False なら、キャッシュがないときは作らずに None を返す。
+    """
+    digest = file_digest(template)
+    _, (w, h), fps = _template_info(template, digest)
+    path = os.path.join(FRAME_CACHE_DIR, f"{digest[:32]}_{seg_start:.3f}_{seg_end:.3f}.rgb")
+    if os.path.exists(path):
+        os.utime(path, None)
+    elif not create:
+        return None
+    else:
+        os.makedirs(FRAME_CACHE_DIR, exist_ok=True)
+        part = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            with span("template_decode"):
+                run_ffmpeg(["-ss", f"{seg_start:.3f}", "-t", f"{seg_end - seg_start:.3f}", "-i", template,
+                            "-an", "-f", "rawvideo", "-pix_fmt", "rgb24", part])
+            os.replace(part, path)
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+        prune_cache_dir(FRAME_CACHE_DIR, FRAME_CACHE_MAX_BYTES, keep=[path])
+    count = os.path.getsize(path) // (w * h * 3)
+    if count == 0:
+        raise RuntimeError(f"テンプレートのデコードに失敗: {template}")
+    return _open_frames(path, (count, h, w, 3)), fps
+
+def template_clip(template, seg_start, seg_end):
+    """テンプレートの区間のクリップ（コマのキャッシュがあればそこから読み、なければ従来どおりデコードする）
+
+    どちらでも VideoFileClip(...).subclip と同じコマを返す。
+    """
+    from moviepy.editor import VideoClip, VideoFileClip
+    cached = template_frames(template, seg_start, seg_end, create=False)
+    if cached is None:
+        return VideoFileClip(template).without_audio().subclip(seg_start, seg_end)
+    frames, fps = cached
+    # moviepy の読み込みと同じく、t 秒には floor(t * fps) 番目のコマを使う
+    first = int(seg_start * fps + 0.00001)
+    last = len(frames) - 1
+    def make_frame(t):
+        return frames[min(max(int((seg_start + t) * fps + 0.00001) - first, 0), last)]
+    return VideoClip(make_frame, duration=seg_end - seg_start)
+
+def write_segment_moviepy(template, seg_start, seg_end, overlays, audio, size, out, profile=DEFAULT_PROFILE):
+    """moviepy で区間 [seg_start, seg_end) を合成して書き出す"""
+    from moviepy.editor import ImageClip, CompositeVideoClip
+    from moviepy.audio.AudioClip import AudioArrayClip
+    duration = seg_end - seg_start
+    clips = []
+    try:
+        with span("template_open"):
+            video = template_clip(template, seg_start, seg_end)
+        clips.append(video)
+        with span("compose", overlays=len(overlays)):
+            layers = [video]
+            for (img, (x, y)), t0, t1 in overlays:
+                s, e = max(t0, seg_start) - seg_start, min(t1, seg_end) - seg_start
+                if e > s:
+                    # 文字の範囲だけの画像を所定の位置に置く（ブレンドはその範囲だけ）
+                    layers.append(ImageClip(img).set_position((x, y)).set_start(s).set_end(e))
+
+            # 音声はミックス済みの配列をそのまま渡す
+            sound = AudioArrayClip(segment_audio(audio, seg_start, seg_end), fps=AUDIO_FPS).set_duration(duration)
+
+            # ★size を target_size に変更
+            # moviepy は np.arange(0, duration, 1/fps) でコマを数えるので、端数で1コマ多く出ることがある。
+            # 連結したときにずれないよう、コマ数がちょうど frame_count になる長さにしておく（音声は元の長さのまま）
+            p = ENCODE_PROFILES[profile]
+            final = CompositeVideoClip(layers, size=size).set_duration((frame_count(duration, p["fps"]) - 0.5) / p["fps"]).set_audio(sound)
+        clips.append(final)
+        params = ["-crf", str(p["crf"])]
+        out_size = encode_size(size, profile)
+        if out_size != tuple(size):
+            params += ["-vf", f"scale={out_size[0]}:{out_size[1]}"]
+        with span("encode", backend="moviepy", profile=profile, seconds=duration):
+            final.write_videofile(out, fps=p["fps"], codec="libx264", preset=p["preset"], ffmpeg_params=params,
+                                  audio_codec="aac", audio_fps=AUDIO_FPS, logger=None)
+    finally:
+        # すべてのクリップを物理的に閉じる（キャッシュ汚染を防ぐ）
+        for c in clips:
+            c.close()
+
+def overlay_chain(args, graph, v, n, overlays, seg_start, seg_end, workdir):
+    """テロップを PNG の入力として args に足し、映像 v に順に重ねるフィルタを graph に足す
+
+    n は次の入力番号。区間 [seg_start, seg_end) に出ないテロップは飛ばす。
+    戻り値は (重ね終わった映像のラベル, 次の入力番号)。
+    """
+    duration = seg_end - seg_start
+    for (img, (x, y)), t0, t1 in overlays:
+        s, e = max(t0, seg_start) - seg_start, min(t1, seg_end) - seg_start
+        if e <= s: continue
+        png = os.path.join(workdir, f"overlay_{n}.png")
+        Image.fromarray(img).save(png, compress_level=1)
+        # 静止画なので 1fps で読めば足りる（overlay は直前のコマを使い続ける）。毎フレーム PNG をデコードし直さない
+        args += ["-framerate", "1", "-loop", "1", "-t", f"{duration:.3f}", "-i", png]
+        # moviepy と同じく [開始, 終了) の間だけ表示する
+        graph.append(f"[{v}][{n}:v]overlay={x}:{y}:enable='gte(t,{s:.3f})*lt(t,{e:.3f})'[v{n}]")
+        v = f"v{n}"
+        n += 1
+    return v, n
+
+def write_segment_ffmpeg(template, seg_start, seg_end, overlays, audio, size, out, profile=DEFAULT_PROFILE):
+    """ffmpeg のフィルタグラフだけで区間 [seg_start, seg_end) を合成して書き出す
+
+    テロップは PNG に書き出して overlay（enable で表示時間を指定）、
+    音声はミックス済みの配列を標準入力からそのまま流し込む。Python 側で1フレームずつ合成しないので速い。
+    レイアウトと表示タイミングは write_segment_moviepy と同じになるように組んでいる。
+    """
+    duration = seg_end - seg_start
+    workdir = tempfile.mkdtemp(prefix="seg_")
+    try:
+        args = ["-ss", f"{seg_start:.3f}", "-t", f"{duration:.3f}", "-i", template]
+        graph = []
+        v, n = overlay_chain(args, graph, "0:v", 1, overlays, seg_start, seg_end, workdir)
+        p = ENCODE_PROFILES[profile]
+        out_size = encode_size(size, profile)
+        # fps 変換で区間の最後のコマが落ちることがあるので、最後のコマを延ばしておいて -frames:v でちょうどに切る
+        graph.append(f"[{v}]fps={p['fps']},tpad=stop_mode=clone:stop_duration=1,scale={out_size[0]}:{out_size[1]},format=yuv420p[vout]")
+
+        args += ["-f", "f32le", "-ar", str(AUDIO_FPS), "-ac", "2", "-i", "pipe:0"]
+        args += [
+            "-filter_complex", ";".join(graph),
+            "-map", "[vout]", "-map", f"{n}:a",
+            "-c:v", "libx264", "-preset", p["preset"], "-crf", str(p["crf"]),
+            "-c:a", "aac", "-ar", str(AUDIO_FPS),
+            "-frames:v", str(frame_count(duration, p["fps"])), out,
+        ]
+        with span("encode", backend="ffmpeg", profile=profile, seconds=duration):
+            run_ffmpeg(args, input=segment_audio(audio, seg_start, seg_end).tobytes())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def frame_count(duration, fps):
+    """区間の長さぶんのコマ数（お題パートと回答パートをつないだときに全体のコマ数がずれないように丸める）"""
+    return int(round(duration * fps))
+
+def write_segment(backend, template, seg_start, seg_end, overlays, audio, size, out, profile=DEFAULT_PROFILE):
+    """区間を合成して書き出す（お題パートと回答パートは必ずこの関数の設定でそろえる）
+
+    overlays は (create_text_image の戻り値, 開始秒, 終了秒) のリスト、
+    audio は mix_timeline で作ったタイムライン全体の音声で、時刻はどれもタイムライン（0〜16秒）上の値。
+    size はレイアウト上のサイズで、実際の出力サイズ・fps・画質は profile（ENCODE_PROFILES）で決まる。
+    """
+    if backend == "ffmpeg":
+        write_segment_ffmpeg(template, seg_start, seg_end, overlays, audio, size, out, profile)
+    else:
+        write_segment_moviepy(template, seg_start, seg_end, overlays, audio, size, out, profile)
+
+def odai_overlays(odai_display, layout):
+    """お題パートのテロップ（i1: 2〜8秒の大きいお題、i2: 8〜10秒の上部のお題）"""
+    odai_main_fontsize, odai_sub_fontsize = odai_font_sizes(odai_display)
+    i1 = create_text_image(odai_display, odai_main_fontsize, "black", pos=layout["pos_odai_main"], canvas_size=layout["target_size"])
+    i2 = create_text_image(odai_display, odai_sub_fontsize, "black", pos=layout["pos_odai_sub"], canvas_size=layout["target_size"])
+    return [(i1, 2.0, 8.0), (i2, 8.0, INTRO_END)]
+
+def answer_overlays(answer_display, layout, end):
+    """回答パートのテロップ（i3: 10秒〜最後、文字数に応じた自動サイズ調整）"""
+    clean_ans_disp = clean_answer_text(answer_display)
+    i3 = create_text_image(clean_ans_disp, ans_font_size(clean_ans_disp), "black", pos=layout["pos_ans"], canvas_size=layout["target_size"])
+    return [(i3, INTRO_END, end)]
+
+def encode_intro(odai_display, odai_audio, layout, intro, odai_voice, backend, profile=DEFAULT_PROFILE):
+    """お題パート（0〜10秒）をエンコードしてキャッシュに保存する"""
+    # 同じお題を別のジョブが同時に作っても衝突しないよう、一意な名前に書いてから置き換える
+    part = f".{uuid.uuid4().hex}.part"
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        # お題の音声合成（ネット待ち）の間にテロップを描いておく
+        voice_future = pool.submit(build_voice_array, odai_audio, "gtts")
+        overlays = odai_overlays(odai_display, layout)
+        voice = voice_future.result()
+
+    # お題音声もキャッシュしておく（10秒をまたぐ分は回答パート側で鳴らす）。
+    # 読みが空でも空の wav を置き、mp4 と wav がそろっていることをキャッシュが有効な条件にする
+    write_wav(odai_voice + part + ".wav", voice if voice is not None else np.zeros((0, 2), dtype=np.float32))
+    os.replace(odai_voice + part + ".wav", odai_voice)
+
+    audio = mix_timeline(media_duration(layout["template"]), odai_voice=voice)
+    write_segment(backend, layout["template"], 0, INTRO_END, overlays, audio, layout["target_size"], intro + part + ".mp4", profile)
+    os.replace(intro + part + ".mp4", intro)
+
+def report_progress(progress, stage, fraction):
+    """進捗コールバックがあれば (段階, 0〜1) を知らせる（ジョブのキャンセルもここで受け取る）"""
+    if progress: progress(stage, fraction)
+
+def prepare_odai_assets(odai_display, odai_audio, video_mode, backend=RENDER_BACKEND, progress=None, profile=DEFAULT_PROFILE):
+    """お題ごとに1回だけでよい処理をまとめて行う
+
+    お題パート（テンプレート＋お題テロップ＋お題音声＋効果音）は
+    (お題, お題の読み, 形式, 素材ファイル, エンコード設定) ごとにディスクへキャッシュし、
+    2回目以降はエンコードせずにそのまま使う。
+    """
+    report_progress(progress, "お題パート準備", 0.05)
+    layout = get_layout(video_mode)
+
+    # チェック対象を current_template に変更
+    for f in [layout["template"], SOUND1, SOUND2]:
+        if not os.path.exists(f):
+            raise FileNotFoundError(f"ファイルが見つかりません: {f}")
+
+    os.makedirs(INTRO_CACHE_DIR, exist_ok=True)
+    # バックエンドごとにエンコード設定が微妙に違うので、連結相手を混ぜないよう別キーにする
+    key = intro_cache_key(odai_display, odai_audio, video_mode, layout["template"], backend, profile)
+    intro = os.path.join(INTRO_CACHE_DIR, f"{key}.mp4")
+    odai_voice = os.path.join(INTRO_CACHE_DIR, f"{key}.wav")
+    if os.path.exists(intro) and os.path.exists(odai_voice):
+        # 使ったことを記録する（LRU での破棄順に使う）
+        for f in [intro, odai_voice]:
+            os.utime(f, None)
+    else:
+        with span("intro", backend=backend, profile=profile):
+            encode_intro(odai_display, odai_audio, layout, intro, odai_voice, backend, profile)
+        prune_cache_dir(INTRO_CACHE_DIR, INTRO_CACHE_MAX_BYTES, keep=[intro, odai_voice])
+
+    return {
+        "layout": layout,
+        "backend": backend,
+        "profile": profile,
+        "intro": intro,
+        "odai_voice": odai_voice,
+    }
+
+def render_answer(assets, answer_display, answer_audio, out, progress=None):
+    """回答パート（10秒以降）だけをエンコードし、お題パートとストリームコピーで連結する（失敗時は例外）"""
+    layout = assets["layout"]
+    stem = out[:-len(".mp4")] + f".{uuid.uuid4().hex}"
+    tail = stem + ".tail.part.mp4"
+    tmp = stem + ".part.mp4"
+    try:
+        report_progress(progress, "回答の音声・テロップ", 0.3)
+        end = media_duration(layout["template"])
+
+        clean_ans_aud = clean_answer_text(answer_audio)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            # 回答の音声合成の間にテロップを描いておく
+            voice_future = pool.submit(build_voice_array, clean_ans_aud, "edge")
+            overlays = answer_overlays(answer_display, layout, end)
+            ans_voice = voice_future.result()
+
+        odai_voice = read_wav(assets["odai_voice"]) if assets["odai_voice"] else None
+        audio = mix_timeline(end, odai_voice=odai_voice, ans_voice=ans_voice)
+        report_progress(progress, "エンコード", 0.5)
+        write_segment(assets["backend"], layout["template"], INTRO_END, end, overlays, audio, layout["target_size"], tail, assets["profile"])
+        report_progress(progress, "連結", 0.9)
+        # 音声は区間ごとの AAC をつながず、タイムライン全体を連結のときに1回だけエンコードする
+        concat_segments([assets["intro"], tail], tmp, audio=audio)
+        # 書き終わってから置き換えるので、途中のファイルが出力キャッシュに見えることはない
+        os.replace(tmp, out)
+        return out
+    finally:
+        for f in [tail, tmp]:
+            if os.path.exists(f):
+                os.remove(f)
+
+# --- 出力キャッシュ：結果に効く入力すべてのハッシュでファイル名を決め、同じ依頼は再レンダリングしない ---
+OUTPUT_DIR = "outputs"
+OUTPUT_CACHE_MAX_BYTES = int(os.environ.get("OOGIRI_OUTPUT_CACHE_MB", "2048")) * 1024 * 1024
+# 合成処理の中身を変えて出力が変わるときはここを上げる（古いキャッシュを使わないように）
+RENDER_VERSION = 2
+
+@cache_resource
+def _file_digest(path, size, mtime_ns):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_digest(path):
+    """ファイル内容の sha256（サイズと更新日時が変わらない限り計算し直さない）"""
+    if not os.path.exists(path):
+        return None
+    info = os.stat(path)
+    return _file_digest(path, info.st_size, info.st_mtime_ns)
+
+def output_path(odai_display, odai_audio, answer_display, answer_audio, video_mode, backend, profile=DEFAULT_PROFILE):
+    """入力（お題・回答の字幕と読み、形式、エンコード設定、素材ファイルの中身、フォント、声）だけで決まる出力ファイル名"""
+    layout = get_layout(video_mode)
+    raw = json.dumps([
+        RENDER_VERSION, odai_display, odai_audio, answer_display, answer_audio, video_mode, backend,
+        profile, ENCODE_PROFILES[profile],
+        file_digest(layout["template"]), file_digest(SOUND1), file_digest(SOUND2),
+        FONT_PATH, file_digest(FONT_PATH), EDGE_VOICE, EDGE_RATE,
+    ], ensure_ascii=False, sort_keys=True)
+    return os.path.join(OUTPUT_DIR, hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32] + ".mp4")
+
+def cached_output(out):
+    """出力がすでにあれば使ったことを記録して True（LRU での破棄順に使う）"""
+    if not os.path.exists(out):
+        return False
+    os.utime(out, None)
+    return True
+
+# --- 読みだけの修正：映像に効く入力が同じ動画があれば、映像はストリームコピーで流用して音声だけ作り直す ---
+def picture_key(odai_display, answer_display, video_mode, backend, profile=DEFAULT_PROFILE):
+    """映像だけに効く入力のハッシュ（読み・声・効果音は含めないので、読みだけ違う動画は同じキーになる）"""
+    layout = get_layout(video_mode)
+    raw = json.dumps([
+        RENDER_VERSION, odai_display, answer_display, video_mode, backend, profile, ENCODE_PROFILES[profile],
+        file_digest(layout["template"]), FONT_PATH, file_digest(FONT_PATH),
+    ], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+def picture_index_path(pkey):
+    # 出力キャッシュの掃除（prune_cache_dir）はサブディレクトリを見ないので、索引は消されない
+    return os.path.join(OUTPUT_DIR, "picture", pkey)
+
+def remember_picture(pkey, out):
+    """この映像の最新の出力ファイルを記録する"""
+    path = picture_index_path(pkey)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    part = f"{path}.{uuid.uuid4().hex}.part"
+    with open(part, "w", encoding="utf-8") as f:
+        f.write(os.path.basename(out))
+    os.replace(part, path)
+
+def picture_source(pkey, out):
+    """同じ映像を持つ既存の出力ファイル（out 自身と、掃除で消えたものは除く）"""
+    try:
+        with open(picture_index_path(pkey), encoding="utf-8") as f:
+            src = os.path.join(OUTPUT_DIR, f.read().strip())
+    except FileNotFoundError:
+        return None
+    if src == out or not os.path.exists(src):
+        return None
+    return src
+
+def timeline_audio(odai_audio, answer_audio, end):
+    """お題と回答の読みからタイムライン全体（0〜end 秒）の音声を作る（2つの音声合成は並行して行う）"""
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        odai_future = pool.submit(build_voice_array, odai_audio, "gtts")
+        ans_voice = build_voice_array(clean_answer_text(answer_audio), "edge")
+        odai_voice = odai_future.result()
+    return mix_timeline(end, odai_voice=odai_voice, ans_voice=ans_voice)
+
+def remux_audio(src, odai_audio, answer_audio, video_mode, out):
+    """src の映像はそのまま（再エンコードしない）で、音声だけを読みから作り直して out に書く"""
+    audio = timeline_audio(odai_audio, answer_audio, media_duration(get_layout(video_mode)["template"]))
+    tmp = out[:-len(".mp4")] + f".{uuid.uuid4().hex}.part.mp4"
+    try:
+        run_ffmpeg([
+            "-i", src, "-f", "f32le", "-ar", str(AUDIO_FPS), "-ac", "2", "-i", "pipe:0",
+            "-map", "0:v", "-map", "1:a", "-c:v", "copy", "-c:a", "aac", "-ar", str(AUDIO_FPS),
+            "-movflags", "+faststart", tmp,
+        ], input=audio.tobytes())
+        os.replace(tmp, out)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def reuse_picture(pkey, odai_audio, answer_audio, video_mode, out, progress=None):
+    """読みだけが違う動画があれば音声を載せ替えて out を作り True を返す（なければ・失敗したら False）"""
+    src = picture_source(pkey, out)
+    if src is None:
+        return False
+    report_progress(progress, "音声の差し替え", 0.5)
+    try:
+        with span("remux", video_mode=video_mode):
+            remux_audio(src, odai_audio, answer_audio, video_mode, out)
+    except Exception:
+        # 流用できなければ通常どおり作り直す（TTS の失敗などはそちらで改めて例外になる）
+        return False
+    return True
+
+def render_geki_video(odai_display, odai_audio, answer_display, answer_audio, video_mode, backend=RENDER_BACKEND, progress=None, profile=DEFAULT_PROFILE):
+    """1本の動画を作って出力パスを返す（同じ入力の動画があればそれをそのまま返す・失敗時は例外）"""
+    out = output_path(odai_display, odai_audio, answer_display, answer_audio, video_mode, backend, profile)
+    if cached_output(out):
+        return out
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    pkey = picture_key(odai_display, answer_display, video_mode, backend, profile)
+    with span("render", backend=backend, video_mode=video_mode, profile=profile):
+        if not reuse_picture(pkey, odai_audio, answer_audio, video_mode, out, progress=progress):
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                # お題パートの準備と並行して、回答の音声を先に合成しておく
+                prefetch = pool.submit(prefetch_tts, clean_answer_text(answer_audio), "edge")
+                assets = prepare_odai_assets(odai_display, odai_audio, video_mode, backend, progress=progress, profile=profile)
+                prefetch.result()
+            render_answer(assets, answer_display, answer_audio, out, progress=progress)
+    remember_picture(pkey, out)
+    prune_cache_dir(OUTPUT_DIR, OUTPUT_CACHE_MAX_BYTES, keep=[out])
+    return out
+
+# --- レンダリング用のプロセスプール：fork は使わない ---
+# 親ではジョブキューのスレッドが計測やテロップキャッシュのロックを持っていることがあり、fork すると
+# 子プロセスにロックがかかったまま複製されて止まりうる。forkserver（なければ spawn）で起動し、
+# 呼び出し側が書き換えたパスなどの設定は initializer で渡す。
+WORKER_SETTINGS = ["FONT_PATH", "FFMPEG_BIN", "SOUND1", "SOUND2", "TRACE_FILE",
+                   "TTS_CACHE_DIR", "INTRO_CACHE_DIR", "FRAME_CACHE_DIR", "OUTPUT_DIR"]
+
+def init_render_worker(settings, tracing):
+    """レンダリング用の子プロセスで、親と同じ設定にそろえる"""
+    globals().update(settings)
+    set_tracing(tracing)
+
+def render_process_pool(max_workers):
+    """親の設定を引き継いだレンダリング用のプロセスプール"""
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    ctx = multiprocessing.get_context(method)
+    settings = {name: globals()[name] for name in WORKER_SETTINGS}
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx,
+                               initializer=init_render_worker, initargs=(settings, tracing_enabled()))
+
+def render_geki_videos_batch(odai_display, odai_audio, answers, video_mode, max_workers=RENDER_WORKERS, backend=RENDER_BACKEND, profile=DEFAULT_PROFILE, progress=None):
+    """1つのお題に対する複数の回答をまとめて動画化する
+
+    answers は (字幕, 読み) のリスト。お題側の処理は1回だけ行い、
+    回答ごとのレンダリングはプロセスプールで並列に実行する（同じ入力の動画があれば作り直さず、
+    読みだけが違う動画があれば音声だけを載せ替える）。
+    戻り値は (answers と同じ順番の出力ファイルのリスト, {番号: 失敗理由})。失敗した回答の出力は None。
+    お題パートの準備自体に失敗したときは例外を投げる。progress には回答が1本できるごとに進捗を知らせる。
+    """
+    results = [None] * len(answers)
+    errors = {}
+    outs = [output_path(odai_display, odai_audio, disp, pron, video_mode, backend, profile) for disp, pron in answers]
+    pkeys = [picture_key(odai_display, disp, video_mode, backend, profile) for disp, _ in answers]
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    todo = []
+    for n, out in enumerate(outs):
+        # 読みだけを直した回答は、前の動画の映像に音声を載せ替えるだけで済ませる
+        if cached_output(out) or reuse_picture(pkeys[n], odai_audio, answers[n][1], video_mode, out):
+            results[n] = out
+        else:
+            todo.append(n)
+
+    try:
+        if not todo:
+            return results, errors
+        report_progress(progress, "お題パート準備", 0.05)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            # 全回答の音声をまとめて先に合成し、各レンダリングプロセスはキャッシュから読むだけにする
+            fragments = [p for n in todo for p in split_audio_text(clean_answer_text(answers[n][1])) if '_' not in p]
+            prefetch = pool.submit(synthesize_fragments, fragments, "edge")
+            # お題パートはここで1回だけエンコード（またはキャッシュから取得）する
+            assets = prepare_odai_assets(odai_display, odai_audio, video_mode, backend, profile=profile)
+            if backend == "moviepy" and use_frame_cache(len(todo), profile):
+                # 回答パートのテンプレートはここで1回だけデコードし、各プロセスはキャッシュを読むだけにする
+                template = assets["layout"]["template"]
+                template_frames(template, INTRO_END, media_duration(template))
+            prefetch.result()
+        with render_process_pool(max_workers) as pool:
+            futures = {}
+            for n in todo:
+                disp, pron = answers[n]
+                futures[pool.submit(render_answer, assets, disp, pron, outs[n])] = n
+            report_progress(progress, f"回答の合成 0/{len(todo)}", 0.3)
+            try:
+                for done, fut in enumerate(as_completed(futures), 1):
+                    n = futures[fut]
+                    try:
+                        results[n] = fut.result()
+                    except Exception as e:
+                        errors[n] = str(e)
+                    report_progress(progress, f"回答の合成 {done}/{len(todo)}", 0.3 + 0.7 * done / len(todo))
+            except RenderCancelled:
+                # まだ始まっていない回答は取り消す（合成中の回答は書き終わるまで待つ）
+                for fut in futures:
+                    fut.cancel()
+                raise
+    finally:
+        for n, r in enumerate(results):
+            if r: remember_picture(pkeys[n], r)
+        prune_cache_dir(OUTPUT_DIR, OUTPUT_CACHE_MAX_BYTES, keep=[r for r in results if r])
+    return results, errors
+
+# --- 複数形式の同時書き出し：縦・横や解像度違いを、1回の音声合成と1つの ffmpeg プロセスでまとめて作る ---
+def write_targets_ffmpeg(layouts, ends, overlays, audio, targets):
+    """形式ごとにテロップを1回だけ重ね、その映像を split してプロファイルごとにエンコードする
+
+    layouts・ends・overlays は形式ごとのレイアウト・長さ・テロップ、audio は全形式で共通の音声、
+    targets は (形式, プロファイル, 出力パス) のリスト。全部の出力を書き終えてから置き換える。
+    """
+    workdir = tempfile.mkdtemp(prefix="targets_")
+    parts = []
+    try:
+        args, graph, outputs = [], [], []
+        n = 0
+        labels = {}
+        for mode, layout in layouts.items():
+            args += ["-t", f"{ends[mode]:.3f}", "-i", layout["template"]]
+            v, n = overlay_chain(args, graph, f"{n}:v", n + 1, overlays[mode], 0, ends[mode], workdir)
+            count = sum(1 for m, _, _ in targets if m == mode)
+            if count > 1:
+                labels[mode] = [f"{v}s{k}" for k in range(count)]
+                graph.append(f"[{v}]split={count}" + "".join(f"[{label}]" for label in labels[mode]))
+            else:
+                labels[mode] = [v]
+        for k, (mode, profile, out) in enumerate(targets):
+            p = ENCODE_PROFILES[profile]
+            out_size = encode_size(layouts[mode]["target_size"], profile)
+            graph.append(f"[{labels[mode].pop(0)}]fps={p['fps']},scale={out_size[0]}:{out_size[1]},format=yuv420p[out{k}]")
+            part = out[:-len(".mp4")] + f".{uuid.uuid4().hex}.part.mp4"
+            parts.append(part)
+            outputs += [
+                "-map", f"[out{k}]", "-map", f"{n}:a",
+                "-c:v", "libx264", "-preset", p["preset"], "-crf", str(p["crf"]),
+                "-c:a", "aac", "-ar", str(AUDIO_FPS),
+                "-t", f"{ends[mode]:.3f}", "-movflags", "+faststart", part,
+            ]
+        args += ["-f", "f32le", "-ar", str(AUDIO_FPS), "-ac", "2", "-i", "pipe:0"]
+        with span("encode", backend="ffmpeg", targets=len(targets), seconds=max(ends.values())):
+            run_ffmpeg(args + ["-filter_complex", ";".join(graph)] + outputs, input=audio.tobytes())
+        for part, (_, _, out) in zip(parts, targets):
+            os.replace(part, out)
+    finally:
+        for part in parts:
+            if os.path.exists(part):
+                os.remove(part)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def render_geki_video_targets(odai_display, odai_audio, answer_display, answer_audio, targets, progress=None):
+    """1つの回答を複数の (形式, プロファイル) でまとめて動画にする（失敗時は例外）
+
+    音声合成とミックスは全部で1回、テロップ画像は形式ごとに1回で、エンコードは1つの ffmpeg プロセスで行う
+    （お題パートのキャッシュは使わず、0秒から通しで合成する）。出力は ffmpeg バックエンドで作ったものとして
+    出力キャッシュに入るので、作り済みの組み合わせは飛ばす。戻り値は targets と同じ順番の出力パスのリスト。
+    """
+    outs = {t: output_path(odai_display, odai_audio, answer_display, answer_audio, t[0], "ffmpeg", t[1]) for t in targets}
+    todo = [t for t in dict.fromkeys(targets) if not cached_output(outs[t])]
+    if todo:
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        with span("render_targets", targets=len(todo)):
+            report_progress(progress, "素材の確認", 0.05)
+            layouts = {mode: get_layout(mode) for mode, _ in todo}
+            for f in [l["template"] for l in layouts.values()] + [SOUND1, SOUND2]:
+                if not os.path.exists(f):
+                    raise FileNotFoundError(f"ファイルが見つかりません: {f}")
+            ends = {mode: media_duration(layout["template"]) for mode, layout in layouts.items()}
+
+            report_progress(progress, "音声合成", 0.1)
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                # 音声合成（ネット待ち）の間に、形式ごとのテロップを描いておく
+                audio_future = pool.submit(timeline_audio, odai_audio, answer_audio, max(ends.values()))
+                overlays = {
+                    mode: odai_overlays(odai_display, layout) + answer_overlays(answer_display, layout, ends[mode])
+                    for mode, layout in layouts.items()
+                }
+                audio = audio_future.result()
+
+            report_progress(progress, "エンコード", 0.3)
+            write_targets_ffmpeg(layouts, ends, overlays, audio, [(mode, profile, outs[(mode, profile)]) for mode, profile in todo])
+        for mode, profile in todo:
+            remember_picture(picture_key(odai_display, answer_display, mode, "ffmpeg", profile), outs[(mode, profile)])
+        prune_cache_dir(OUTPUT_DIR, OUTPUT_CACHE_MAX_BYTES, keep=list(outs.values()))
+    return [outs[t] for t in targets]
+
+# --- 静止画プレビュー：エンコードせずに代表的な時刻の1コマだけを合成し、テロップの収まりを確認する ---
+KEYFRAME_TIMES = (5.0, 9.0, 13.0)   # 大きいお題・上部のお題・回答 がそれぞれ出ている時刻
+KEYFRAME_SCALE = 0.5                # 画面に並べる用に縮小する倍率
+
+@cache_resource(max_entries=32)
+def _template_frame(template, t, digest):
+    _, (w, h), _ = _template_info(template, digest)
+    proc = subprocess.run(
+        [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-ss", f"{t:.3f}", "-i", template,
+         "-frames:v", "1", "-f", "rawvideo", "-pix_fmt", "rgb24", "-"],
+        capture_output=True,
+    )
+    if proc.returncode != 0 or len(proc.stdout) < w * h * 3:
+        raise RuntimeError(f"フレームの取り出しに失敗: {template} {t}秒")
+    return np.frombuffer(proc.stdout[:w * h * 3], dtype=np.uint8).reshape(h, w, 3)
+
+def template_frame(template, t):
+    """テンプレートの t 秒のコマ（テンプレートの中身と時刻ごとに1回だけデコードする・書き換えないこと）"""
+    return _template_frame(template, t, file_digest(template))
+
+@cache_resource(max_entries=32)
+def _keyframe_base(template, t, size, scale, digest):
+    """テロップを重ねる前の下地（縮小済み）"""
+    # 合成時と同じく、テンプレートは左上に合わせて置く
+    canvas = Image.new("RGB", size, (0, 0, 0))
+    canvas.paste(Image.fromarray(_template_frame(template, t, digest)), (0, 0))
+    if scale != 1:
+        canvas = canvas.resize((int(size[0] * scale), int(size[1] * scale)), Image.BILINEAR)
+    return canvas
+
+def touches_edge(img, offset, canvas_size):
+    """テロップ画像がキャンバスの端で切れている（はみ出している）か"""
+    h, w = img.shape[:2]
+    if w <= 1 and h <= 1:
+        return False
+    x, y = offset
+    return x <= 0 or y <= 0 or x + w >= canvas_size[0] or y + h >= canvas_size[1]
+
+def keyframe_previews(odai_display, answer_display, video_mode, times=KEYFRAME_TIMES, scale=KEYFRAME_SCALE):
+    """代表時刻ごとの (秒, JPEG のバイト列, はみ出しているか) のリスト
+
+    テロップは動画と同じ create_text_image・同じ表示区間で重ねるので、配置は書き出す動画と同じになる。
+    下地（テンプレートのコマ）は縮小済みのものをキャッシュし、テロップだけを縮小して重ねる。
+    """
+    layout = get_layout(video_mode)
+    size = tuple(layout["target_size"])
+    digest = file_digest(layout["template"])
+    end, _, _ = _template_info(layout["template"], digest)
+    overlays = odai_overlays(odai_display, layout) + answer_overlays(answer_display, layout, end)
+    results = []
+    for t in times:
+        with span("keyframe", video_mode=video_mode):
+            canvas = _keyframe_base(layout["template"], t, size, scale, digest).copy()
+            overflow = False
+            for (img, (x, y)), t0, t1 in overlays:
+                if not t0 <= t < t1:
+                    continue
+                layer = Image.fromarray(img)
+                if scale != 1:
+                    layer = layer.resize((max(1, round(layer.width * scale)), max(1, round(layer.height * scale))), Image.BILINEAR)
+                canvas.paste(layer, (round(x * scale), round(y * scale)), layer)
+                overflow = overflow or touches_edge(img, (x, y), size)
+            buf = io.BytesIO()
+            canvas.save(buf, format="JPEG", quality=85)
+        results.append((t, buf.getvalue(), overflow))
+    return results
+
+# --- レンダリングジョブ：生成をバックグラウンドで動かし、画面操作を止めない ---
+RENDER_JOB_WORKERS = 2
+RENDER_JOB_MAX_PENDING = 20
+
+class RenderCancelled(Exception):
+    """キャンセルされたジョブを途中で止めるための例外"""
+
+class RenderJobQueue:
+    """動画生成ジョブの待ち行列（上限つきのワーカープールで順番に処理する）
+
+    ジョブの状態は queued → running → done / failed / cancelled と進み、
+    実行中は段階名と進捗（0〜1）を持つ。キャンセルは段階の切れ目で反映される。
+    1本の動画（submit）のほか、縦・横のまとめ書き出し（submit_targets）と全回答の一括生成（submit_batch）も
+    1つのジョブとして扱う。結果（result）はそれぞれの render_* 関数の戻り値。
+    """
+
+    def __init__(self, max_workers=RENDER_JOB_WORKERS, max_pending=RENDER_JOB_MAX_PENDING):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="render")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_pending = max_pending
+
+    def submit(self, odai_display, odai_audio, answer_display, answer_audio, video_mode, backend=RENDER_BACKEND, profile=DEFAULT_PROFILE):
+        """1本の動画のジョブを登録して ID を返す（待ちが上限を超えていたら RuntimeError）"""
+        args = (odai_display, odai_audio, answer_display, answer_audio, video_mode, backend)
+        return self._enqueue(render_geki_video, args, {"profile": profile}, profile)
+
+    def submit_targets(self, odai_display, odai_audio, answer_display, answer_audio, targets):
+        """1つの回答を複数の (形式, プロファイル) でまとめて書き出すジョブ（結果は targets と同じ順番のパスのリスト）"""
+        args = (odai_display, odai_audio, answer_display, answer_audio, targets)
+        return self._enqueue(render_geki_video_targets, args, {}, None)
+
+    def submit_batch(self, odai_display, odai_audio, answers, video_mode, backend=RENDER_BACKEND, profile=DEFAULT_PROFILE):
+        """全回答の一括生成のジョブ（結果は (answers と同じ順番のパスのリスト, {番号: 失敗理由})）"""
+        args = (odai_display, odai_audio, answers, video_mode)
+        return self._enqueue(render_geki_videos_batch, args, {"backend": backend, "profile": profile}, profile)
+
+    def _enqueue(self, func, args, kwargs, profile):
+        with self._lock:
+            pending = sum(1 for j in self._jobs.values() if j["state"] in ("queued", "running"))
+            if pending >= self.max_pending:
+                raise RuntimeError("生成待ちが混み合っています。少し待ってから実行してください。")
+            job_id = uuid.uuid4().hex[:12]
+            self._jobs[job_id] = {
+                "id": job_id, "state": "queued", "stage": "待機中", "progress": 0.0,
+                "result": None, "error": None, "cancel": False, "profile": profile,
+            }
+            self._forget_old_jobs()
+        self._pool.submit(self._run, job_id, func, args, kwargs)
+        return job_id
+
+    def get(self, job_id):
+        """ジョブの状態のコピー（知らない ID なら None）"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job: return
+            job["cancel"] = True
+            if job["state"] == "queued":
+                job["state"], job["stage"] = "cancelled", "キャンセル"
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+
+    def _forget_old_jobs(self, keep=200):
+        # 終わったジョブの記録は古いものから捨てる
+        finished = [k for k, j in self._jobs.items() if j["state"] in ("done", "failed", "cancelled")]
+        for k in finished[:max(0, len(self._jobs) - keep)]:
+            del self._jobs[k]
+
+    def _run(self, job_id, func, args, kwargs):
+        with self._lock:
+            if self._jobs[job_id]["cancel"]: return
+            self._jobs[job_id]["state"] = "running"
+
+        def progress(stage, fraction):
+            with self._lock:
+                job = self._jobs[job_id]
+                if job["cancel"]: raise RenderCancelled()
+                job["stage"], job["progress"] = stage, fraction
+
+        try:
+            out = func(*args, progress=progress, **kwargs)
+            self._update(job_id, state="done", stage="完了", progress=1.0, result=out)
+        except RenderCancelled:
+            self._update(job_id, state="cancelled", stage="キャンセル")
+        except Exception as e:
+            import traceback
+            self._update(job_id, state="failed", stage="失敗", error=f"{e}\n{traceback.format_exc()}")
+
+@cache_resource
+def get_render_queue():
+    """全セッションで共有するジョブキュー"""
+    return RenderJobQueue()
+
+# --- Gemini 呼び出し：モデルは使い回し、同じプロンプトの応答はディスクから返す ---
+LLM_CACHE_DIR = os.path.join("cache", "llm")
+LLM_CACHE_MAX_BYTES = 50 * 1024 * 1024
+LLM_CACHE_TTL = float(os.environ.get("OOGIRI_LLM_CACHE_TTL_HOURS", "168")) * 3600
+
+_gemini_api_key = None
+
+def configure_gemini(api_key):
+    """API キーを覚えておく（google.generativeai の読み込みと設定は、最初に LLM を呼ぶときまで遅らせる）"""
+    global _gemini_api_key
+    _gemini_api_key = api_key
+
+class GeminiBackend:
+    """google.generativeai を呼ぶ本番用バックエンド（モデルはモデル名ごとに1つ作って使い回す）"""
+
+    def __init__(self):
+        self._models = {}
+        self._api_key = None
+        self._lock = threading.Lock()
+
+    def _model(self, model):
+        import google.generativeai as genai
+        with self._lock:
+            if _gemini_api_key and _gemini_api_key != self._api_key:
+                # キーが設定された・変わったときだけ設定し直す
+                genai.configure(api_key=_gemini_api_key)
+                self._api_key = _gemini_api_key
+                self._models.clear()
+            if model not in self._models:
+                self._models[model] = genai.GenerativeModel(model)
+            return self._models[model]
+
+    def generate(self, model, prompt, params):
+        return self._model(model).generate_content(prompt, generation_config=params or None).text
+
+    def stream(self, model, prompt, params):
+        return response_chunks(self._model(model).generate_content(prompt, generation_config=params or None, stream=True))
+
+class LLMClient:
+    """応答キャッシュ付きの LLM クライアント
+
+    キーは (モデル, プロンプト, 生成パラメータ) のハッシュ。期限切れ（LLM_CACHE_TTL）は使わず、
+    合計サイズが上限を超えたら古いものから消す。backend は generate/stream を持つものなら何でもよく、
+    テストでは手元の偽モデルに差し替えられる。
+    空の応答や、usable（応答テキストを受け取る関数）が使えないと判定した応答は保存しない
+    （失敗した応答をキャッシュから返し続けないように）。
+    """
+
+    def __init__(self, backend, cache_dir=LLM_CACHE_DIR, ttl=LLM_CACHE_TTL, max_bytes=LLM_CACHE_MAX_BYTES):
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def cache_path(self, model, prompt, params):
+        raw = json.dumps([model, prompt, params or {}], ensure_ascii=False, sort_keys=True)
+        return os.path.join(self.cache_dir, hashlib.sha256(raw.encode("utf-8")).hexdigest() + ".json")
+
+    @staticmethod
+    def _usable(text, usable):
+        return bool(text.strip()) and (usable is None or usable(text))
+
+    def _load(self, path, usable=None):
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry["created"] > self.ttl:
+            return None
+        if not self._usable(entry["text"], usable):
+            return None   # 以前に保存された使えない応答は呼び直す
+        os.utime(path)   # 最後に使った時刻を更新（容量超過時に消す順番に使う）
+        return entry["text"]
+
+    def _store(self, path, text):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        part = f"{path}.{uuid.uuid4().hex}.part"
+        with open(part, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "text": text}, f, ensure_ascii=False)
+        os.replace(part, path)
+        prune_cache_dir(self.cache_dir, self.max_bytes, keep=[path])
+
+    def generate(self, prompt, model=CHOSEN_MODEL, params=None, force_fresh=False, usable=None):
+        """応答テキストを返す（force_fresh ならキャッシュを見ずに呼び、使える応答なら結果で上書きする）"""
+        path = self.cache_path(model, prompt, params)
+        text = None if force_fresh else self._load(path, usable)
+        if text is None:
+            with span("llm", kind="generate", model=model, prompt_chars=len(prompt)):
+                text = self.backend.generate(model, prompt, params)
+            if self._usable(text, usable):
+                self._store(path, text)
+        return text
+
+    def stream(self, prompt, model=CHOSEN_MODEL, params=None, force_fresh=False, usable=None):
+        """応答をテキスト断片の列で返す（キャッシュにあれば一度に返す）
+
+        最後まで読み切った、使える応答だけをキャッシュする。途中で止めた応答は保存しない。
+        """
+        path = self.cache_path(model, prompt, params)
+        text = None if force_fresh else self._load(path, usable)
+        if text is not None:
+            yield text
+            return
+        parts = []
+        with span("llm", kind="stream", model=model, prompt_chars=len(prompt)) as sp:
+            start = time.perf_counter()
+            for chunk in self.backend.stream(model, prompt, params):
+                if not parts:
+                    # 最初の断片が届くまでの時間（回答一覧に1件目が出るまでの待ち時間）
+                    sp.set(first_chunk=round(time.perf_counter() - start, 4))
+                parts.append(chunk)
+                yield chunk
+        text = "".join(parts)
+        if self._usable(text, usable):
+            self._store(path, text)
+
+@cache_resource
+def get_llm_client():
+    """全セッションで共有する LLM クライアント"""
+    return LLMClient(GeminiBackend())
+
+# --- 回答の逐次パース：ストリーミング応答を行単位で読み、届いた回答から順に返す ---
+ANSWER_COUNT = 20
+PREAMBLE_WORDS = ['はい', '承知', 'それでは', '以下', '提案']
+
+def parse_answer_line(line):
+    """「1. 回答」形式の1行から回答本文を取り出す（番号行でない・前置きなら None）"""
+    line = line.strip()
+    if re.match(r'^[0-9０-９]+[\.．、。\s]', line):
+        if not any(word in line[:20] for word in PREAMBLE_WORDS):
+            # ★番号を削除してから返す
+            return re.sub(r'^[0-9０-９]+[\.．、。\s]+', '', line).strip()
+    return None
+
+def iter_numbered_answers(chunks, limit=ANSWER_COUNT):
+    """テキスト断片の列から回答を逐次取り出す
+
+    改行が届いた時点で1行を確定させてパースし、最後の行は入力の終わりで確定させる。
+    chunks は文字列のイテラブルなら何でもよい（ストリーミング応答・テスト用の偽モデルなど）。
+    limit 件を超えた分は返さないが、応答は最後まで読む（読み切った応答だけがキャッシュされるため）。
+    """
+    buf = ""
+    count = 0
+    for chunk in chunks:
+        buf += chunk
+        *lines, buf = buf.split("\n")
+        for line in lines:
+            ans = parse_answer_line(line)
+            if ans and count < limit:
+                yield ans
+                count += 1
+    ans = parse_answer_line(buf)
+    if ans and count < limit:
+        yield ans
+
+def has_answers(text):
+    """応答テキストから回答が1件でも取れるか"""
+    return next(iter_numbered_answers([text]), None) is not None
+
+def response_chunks(response):
+    """Gemini のストリーミング応答をテキスト断片の列にする"""
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # 安全フィルタなどで本文のない断片は飛ばす
+            continue
+        if text:
+            yield text
+
+# --- 生成：お題と回答（画面からも一括処理からも同じプロンプト・同じパースを使う） ---
+ODAI_COUNT = 3
+
+def odai_prompt(keyword):
+    return f"「{keyword}」をテーマにした大喜利お題を3つ作れ。お題だけを3行で出力。"
+
+def parse_odais(text):
+    """お題生成の応答から、番号を除いたお題を最大 ODAI_COUNT 件取り出す"""
+    lines = text.split('\n')
+    odais = []
+    
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        cleaned = re.sub(r'^[0-9０-９]+[\.．\s]+', '', line).strip()
+        if len(cleaned) >= 10:
+            odais.append(cleaned)
+    return odais[:ODAI_COUNT]
+
+def generate_odais(keyword, force_fresh=False, client=None):
+    client = client or get_llm_client()
+    # お題が1つも取れない応答（断り文など）はキャッシュしない
+    return parse_odais(client.generate(odai_prompt(keyword), force_fresh=force_fresh, usable=parse_odais))
+
+def answer_prompt(odai, style, examples):
+    """回答20案生成のプロンプト（examples は傑作選に入れる学習データ）"""
+    ex_str = "\n".join([f"・{e['ans']}" for e in examples])
+    
+    #p = f"""あなたは伝説の大喜利芸人です。
+
+#お題: {odai}
+#雰囲気: {style}
+
+#参考となる傑作回答:
+#{ex_str}
+
+#指示:
+#1. 上記の手本を参考に、同じレベルの面白い回答を20個考えろ
+#2. 挨拶、説明、前置きは絶対に書くな
+#3. 番号付きリスト形式で出力しろ（1. 回答）
+#4. カッコ書きの説明は禁止
+#5. 回答だけを書け
+#"""
+
+    # --- 修正後：YouTubeチャンネル『大喜利アンサー』専用プロンプト ---
+    p = f"""あなたはYouTubeチャンネル『大喜利アンサー』を運営する伝説のクリエイター兼大喜利芸人です。
+視聴者が思わず吹き出し、チャンネル登録したくなるようなキレ味鋭い回答を生成してください。
+
+【お題】: {odai}
+【ユーモアの方向性】: {style}
+
+【大喜利アンサー 傑作選（このトーンを再現せよ）】:
+{ex_str}
+
+【絶対ルール】:
+1. 傑作選の「視点の鋭さ」「短文での爆発力」を継承し、同等以上の回答を考えろ。
+2. 「ブラック」指定時は、YouTubeの規約に触れない絶妙なラインで、シュールかつ猛毒な笑いを攻めろ。
+3. 挨拶・前置き・「はい、回答します」等は一切禁止。即座に回答を始めろ。
+4. 番号付きリスト形式（1. 回答）で、正確に20案出力しろ。
+5. 言葉を削ぎ落とし、視聴者の想像力を刺激する一撃のフレーズを重視しろ。
+"""
+    return p
+
+def stream_answers(odai, style="通常", force_fresh=False, client=None, store=None):
+    """お題に対する回答を、届いた順に1件ずつ返す"""
+    # 全件ではなく、選んだお題に近い例を FEW_SHOT_K 件だけ使う（プロンプト長を一定に保つ）
+    examples = (store or get_learning_store()).similar(odai, FEW_SHOT_K, style)
+    client = client or get_llm_client()
+    # 回答が1件も取れない応答（断り文など）はキャッシュしない
+    return iter_numbered_answers(client.stream(answer_prompt(odai, style, examples), force_fresh=force_fresh, usable=has_answers))
+
@@ -0,0 +1,282 @@
+# 大喜利アンサーの一括処理：マニフェスト（JSONL）からお題・回答・動画を画面なしでまとめて作る
+#
+# 使い方（リポジトリ直下で実行。テンプレート動画・フォント・効果音を相対パスで読むため）:
+#   GEMINI_API_KEY=... python pipeline.py manifest.jsonl --out results.jsonl
+#
+# マニフェストは1行1件の JSON:
+#   {"id": "sauna", "keyword": "サウナ"}                              キーワードからお題を作る
+#   {"id": "mago", "odai": "孫が大激怒。何があった？", "style": "ブラック"}   お題を指定して回答を作る
+#   {"odai": "…", "odai_audio": "…", "answers": ["回答1", ["字幕", "読み"]]}  回答も指定する（LLM を呼ばない）
+# 任意の項目: style（通常/知的/ブラック）, video_mode（縦動画 (9:16)/横動画 (16:9)）,
+#             odais（キーワード1つから作るお題の数）, answers_per_odai（お題1つから作る動画の数）
+#
+# --targets "縦:final,横:final,縦:preview" のように (形式:エンコード設定) を並べると、1つの回答から
+# その組み合わせの動画を1回の音声合成・1つの ffmpeg プロセスでまとめて作る（--video-mode などは使わない）。
+#
+# 結果は --out に1行ずつ追記する（status: odai / video / video_failed / done / failed）。
+# 途中で止まっても、同じコマンドをもう一度実行すれば done になっていない項目から続ける。
+# LLM の応答・音声・動画はそれぞれキャッシュされるので、やり直した項目も済んだ所まではすぐ進む。
+import os
+import sys
+import time
+import json
+import random
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from oogiri_core import (
+    RENDER_BACKEND, RENDER_BACKENDS, RENDER_WORKERS, TTS_CONCURRENCY, ENCODE_PROFILES, DEFAULT_PROFILE,
+    generate_odais, stream_answers, clean_answer_text, prefetch_tts, render_geki_videos_batch,
+    render_geki_video_targets, configure_gemini,
+)
+
+VIDEO_MODES = ["縦動画 (9:16)", "横動画 (16:9)"]
+STYLES = ["通常", "知的", "ブラック"]
+
+class RateLimiter:
+    """呼び出しの間隔を 1/rate 秒以上あける（スレッド間で共有）"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+def call_with_retry(fn, limiter, retries, base_delay, label):
+    """fn を呼ぶ。失敗したら指数的に待ち時間を延ばして retries 回までやり直す"""
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = base_delay * (2 ** attempt) * random.uniform(0.5, 1.5)
+            log(f"{label}: {e}（{delay:.1f}秒後に再試行 {attempt + 1}/{retries}）")
+            time.sleep(delay)
+
+def log(message):
+    print(f"[{time.strftime('%H:%M:%S')}] {message}", file=sys.stderr, flush=True)
+
+def item_id(item):
+    """id がなければ内容のハッシュを使う（行の並びが変わっても同じ項目は同じ id になる）"""
+    if item.get("id"):
+        return str(item["id"])
+    raw = json.dumps(item, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+
+def read_manifest(path):
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            item = json.loads(line)
+            if "keyword" not in item and "odai" not in item:
+                raise ValueError(f"{path}:{n}: keyword か odai が必要です")
+            items.append(item)
+    return items
+
+def finished_ids(path):
+    """結果ファイルから、最後まで終わった項目の id を集める"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 書き込み途中で落ちた最後の行は読み飛ばす
+                continue
+            if record.get("status") == "done":
+                done.add(record["id"])
+    return done
+
+class ResultLog:
+    """結果ファイルへの追記（1行ごとにディスクまで書き切るので、落ちても書いた行は残る）"""
+
+    def __init__(self, path):
+        self._f = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def write(self, **record):
+        with self._lock:
+            self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def close(self):
+        self._f.close()
+
+def parse_targets(spec):
+    """"縦:final,横:preview" を [(形式, エンコード設定), ...] にする（形式は先頭の文字だけでもよい）"""
+    targets = []
+    for part in spec.split(","):
+        mode, _, profile = part.strip().rpartition(":")
+        matched = [m for m in VIDEO_MODES if m.startswith(mode)] if mode else []
+        if len(matched) != 1 or profile not in ENCODE_PROFILES:
+            raise argparse.ArgumentTypeError(f"書き出し先の指定が正しくありません: {part}")
+        targets.append((matched[0], profile))
+    return targets
+
+def render_group(odai, odai_audio, answers, video_mode, args):
+    """1つのお題の回答を動画にする。戻り値は [(形式, エンコード設定, 出力パスのリスト（失敗は None）)] と {番号: 失敗理由}"""
+    if not args.targets:
+        paths, errors = render_geki_videos_batch(
+            odai, odai_audio, answers, video_mode, max_workers=args.workers, backend=args.backend,
+            profile=args.profile,
+        )
+        return [(video_mode, args.profile, paths)], errors
+    # 複数の書き出し先があるときは、回答ごとに1つの ffmpeg プロセスで全部を作る
+    per_target = [[None] * len(answers) for _ in args.targets]
+    errors = {}
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(render_geki_video_targets, odai, odai_audio, disp, pron, args.targets): n
+            for n, (disp, pron) in enumerate(answers)
+        }
+        for fut in as_completed(futures):
+            n = futures[fut]
+            try:
+                for paths, path in zip(per_target, fut.result()):
+                    paths[n] = path
+            except Exception as e:
+                errors[n] = str(e)
+    return [(mode, profile, paths) for (mode, profile), paths in zip(args.targets, per_target)], errors
+
+def normalize_answers(answers):
+    """回答の指定を (字幕, 読み) の組にそろえる"""
+    pairs = []
+    for a in answers:
+        if isinstance(a, str):
+            pairs.append((a, a))
+        else:
+            pairs.append((a[0], a[1]))
+    return pairs
+
+def prepare_item(item, args, limiter):
+    """1項目分のお題と回答を用意し、回答の音声を先に合成しておく
+
+    戻り値は [(お題, お題の読み, [(字幕, 読み), ...]), ...]。
+    """
+    iid = item_id(item)
+    style = item.get("style", args.style)
+    per_odai = int(item.get("answers_per_odai", args.answers_per_odai))
+    if "odai" in item:
+        odais = [(item["odai"], item.get("odai_audio", item["odai"]))]
+    else:
+        generated = call_with_retry(
+            lambda: generate_odais(item["keyword"], force_fresh=args.force_fresh),
+            limiter, args.retries, args.backoff, f"{iid} お題生成",
+        )
+        if not generated:
+            raise RuntimeError("お題を生成できませんでした")
+        odais = [(o, o) for o in generated[:int(item.get("odais", args.odais))]]
+
+    groups = []
+    for odai, odai_audio in odais:
+        if "answers" in item:
+            answers = normalize_answers(item["answers"])
+        else:
+            generated = call_with_retry(
+                lambda: list(stream_answers(odai, style, force_fresh=args.force_fresh)),
+                limiter, args.retries, args.backoff, f"{iid} 回答生成",
+            )
+            if not generated:
+                raise RuntimeError(f"回答を生成できませんでした: {odai}")
+            answers = [(a, a) for a in generated]
+        answers = answers[:per_odai]
+        for _, pron in answers:
+            prefetch_tts(clean_answer_text(pron), "edge", args.tts_concurrency)
+        groups.append((odai, odai_audio, answers))
+    return groups
+
+def run(args):
+    items = read_manifest(args.manifest)
+    done = finished_ids(args.out)
+    todo = [item for item in items if item_id(item) not in done]
+    log(f"{len(items)}件中 {len(items) - len(todo)}件は完了済み、{len(todo)}件を処理します")
+    if not todo:
+        return 0
+
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if api_key:
+        configure_gemini(api_key)
+    elif any("answers" not in item for item in todo):
+        log("GEMINI_API_KEY が設定されていません（キャッシュにない生成は失敗します）")
+
+    results = ResultLog(args.out)
+    limiter = RateLimiter(args.llm_rate)
+    failed = 0
+    try:
+        # お題・回答・音声の準備は先行して並列に進め、できた項目から順に動画を作る
+        # （準備のスレッドはレート制限や計測のロックを持っていることがあるが、動画合成の子プロセスは
+        #   fork ではなく forkserver から起動するので、ロックが子に複製されて止まることはない）
+        with ThreadPoolExecutor(max_workers=args.llm_concurrency) as pool:
+            futures = {pool.submit(prepare_item, item, args, limiter): item for item in todo}
+            for fut in as_completed(futures):
+                item = futures[fut]
+                iid = item_id(item)
+                video_mode = item.get("video_mode", args.video_mode)
+                try:
+                    groups = fut.result()
+                    ok = True
+                    for odai, odai_audio, answers in groups:
+                        results.write(id=iid, status="odai", odai=odai, answers=[disp for disp, _ in answers])
+                        log(f"{iid}: {odai}（{len(answers)}本）")
+                        outputs, errors = render_group(odai, odai_audio, answers, video_mode, args)
+                        for mode, profile, paths in outputs:
+                            for n, (disp, _) in enumerate(answers):
+                                if paths[n]:
+                                    results.write(id=iid, status="video", odai=odai, answer=disp, path=paths[n],
+                                                  video_mode=mode, profile=profile)
+                                else:
+                                    ok = False
+                                    results.write(id=iid, status="video_failed", odai=odai, answer=disp, error=errors.get(n),
+                                                  video_mode=mode, profile=profile)
+                    if not ok:
+                        raise RuntimeError("一部の動画の合成に失敗しました")
+                    results.write(id=iid, status="done")
+                    log(f"{iid}: 完了")
+                except Exception as e:
+                    failed += 1
+                    results.write(id=iid, status="failed", error=str(e))
+                    log(f"{iid}: 失敗 {e}")
+    finally:
+        results.close()
+    log(f"終了（失敗 {failed}件）")
+    return 1 if failed else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="マニフェストからお題・回答・動画をまとめて生成する")
+    parser.add_argument("manifest", help="入力マニフェスト（JSONL）")
+    parser.add_argument("--out", default="results.jsonl", help="結果の追記先（JSONL）。再実行時はここから再開する")
+    parser.add_argument("--video-mode", default=VIDEO_MODES[0], choices=VIDEO_MODES)
+    parser.add_argument("--style", default=STYLES[0], choices=STYLES)
+    parser.add_argument("--odais", type=int, default=1, help="キーワード1つから作るお題の数")
+    parser.add_argument("--answers-per-odai", type=int, default=3, help="お題1つから作る動画の数")
+    parser.add_argument("--backend", default=RENDER_BACKEND, choices=RENDER_BACKENDS)
+    parser.add_argument("--profile", default=DEFAULT_PROFILE, choices=sorted(ENCODE_PROFILES), help="エンコード設定")
+    parser.add_argument("--targets", type=parse_targets, default=None,
+                        help="まとめて書き出す (形式:エンコード設定) の組。例: 縦:final,横:final（ffmpeg で合成する）")
+    parser.add_argument("--workers", type=int, default=RENDER_WORKERS, help="動画合成のプロセス数")
+    parser.add_argument("--llm-concurrency", type=int, default=2, help="先行して準備する項目の数")
+    parser.add_argument("--llm-rate", type=float, default=0.5, help="LLM 呼び出しの上限（回/秒）")
+    parser.add_argument("--retries", type=int, default=4, help="LLM 呼び出しの再試行回数")
+    parser.add_argument("--backoff", type=float, default=2.0, help="再試行の最初の待ち時間（秒）")
+    parser.add_argument("--tts-concurrency", type=int, default=TTS_CONCURRENCY)
+    parser.add_argument("--force-fresh", action="store_true", help="LLM の応答キャッシュを使わない")
+    return run(parser.parse_args(argv))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,5 @@
+# リポジトリ直下の oogiri_core をテストから import できるようにする
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,40 @@
+# LLM のストリーミング応答から回答を取り出す処理のテスト
+from oogiri_core import iter_numbered_answers, parse_answer_line
+
+
+def test_line_split_across_chunks():
+    chunks = ["1. 入れ", "歯を売っ", "た\n2", ". スマホを", "割った\n"]
+    assert list(iter_numbered_answers(chunks)) == ["入れ歯を売った", "スマホを割った"]
+
+
+def test_last_line_without_newline():
+    assert list(iter_numbered_answers(["1. 一つ目\n2. 二つ目"])) == ["一つ目", "二つ目"]
+
+
+def test_preamble_and_unnumbered_lines_are_skipped():
+    chunks = ["はい、以下が回答です。\n", "1. 承知しました。20個提案します\n", "\n", "2. 本物の回答\n", "補足の説明\n"]
+    assert list(iter_numbered_answers(chunks)) == ["本物の回答"]
+
+
+def test_fullwidth_numbers_and_separators():
+    assert parse_answer_line("１２．全角の番号") == "全角の番号"
+    assert parse_answer_line("3、読点の区切り") == "読点の区切り"
+    assert parse_answer_line("回答だけの行") is None
+
+
+def test_limit_stops_yielding_but_reads_to_the_end():
+    read = []
+
+    def chunks():
+        for i in range(1, 26):
+            read.append(i)
+            yield f"{i}. 回答{i}\n"
+
+    answers = list(iter_numbered_answers(chunks()))
+    assert answers == [f"回答{i}" for i in range(1, 21)]
+    # 応答は最後まで読む（読み切った応答だけがキャッシュされるため）
+    assert read == list(range(1, 26))
+
+
+def test_custom_limit():
+    assert list(iter_numbered_answers(["1. a\n2. b\n3. c"], limit=2)) == ["a", "b"]
@@ -0,0 +1,96 @@
+# 学習データのインポート（JSON 配列・JSONL の逐次読み込み）のテスト
+import io
+import json
+
+import pytest
+
+from oogiri_core import iter_json_records, normalize_record
+
+CHUNK_SIZES = [1, 2, 3, 7, 64 * 1024]
+
+
+def read_all(text, chunk_size, binary=False):
+    f = io.BytesIO(text.encode("utf-8")) if binary else io.StringIO(text)
+    return list(iter_json_records(f, chunk_size))
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_array(chunk_size):
+    records = [{"odai": "お題", "ans": "回答", "style": "通常"}, {"odai": "二つ目", "ans": ["入れ子", 1]}]
+    text = json.dumps(records, ensure_ascii=False, indent=2)
+    assert read_all(text, chunk_size) == records
+    assert read_all(text, chunk_size, binary=True) == records
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_jsonl(chunk_size):
+    text = '{"odai": "あ", "ans": "い"}\n\n{"odai": "う", "ans": "え"}\r\n'
+    assert read_all(text, chunk_size, binary=True) == [{"odai": "あ", "ans": "い"}, {"odai": "う", "ans": "え"}]
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_scalars_are_not_split_at_chunk_boundaries(chunk_size):
+    assert read_all("12\n34", chunk_size) == [12, 34]
+    assert read_all("[12, 345 ,\"x\"]", chunk_size) == [12, 345, "x"]
+
+
+def test_bom_and_multibyte_characters_split_across_reads():
+    data = "\ufeff" + json.dumps([{"odai": "孫がブチギレ", "ans": "入れ歯"}], ensure_ascii=False)
+    records = list(iter_json_records(io.BytesIO(data.encode("utf-8")), 1))
+    assert records == [{"odai": "孫がブチギレ", "ans": "入れ歯"}]
+
+
+@pytest.mark.parametrize("text", ["", "  \n", "[]", " [ ] \n"])
+def test_empty(text):
+    assert read_all(text, 2) == []
+
+
+@pytest.mark.parametrize("text", [
+    '[{"a": 1} {"b": 2}]',   # 区切りの , がない
+    "[1,]",                  # 末尾の ,
+    "[,1]",
+    '[{"a": 1}',             # 閉じていない
+    "[1] 2",                 # 配列の後ろに余分なデータ
+    '{"a": 1} {"b": 2}',     # JSONL の1行に2件
+    '{"a": ',
+])
+@pytest.mark.parametrize("chunk_size", [1, 64 * 1024])
+def test_broken_json_raises(text, chunk_size):
+    with pytest.raises(ValueError):
+        read_all(text, chunk_size)
+
+
+class CountingReader(io.StringIO):
+    """読んだ文字数を数える"""
+    read_chars = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.read_chars += len(data)
+        return data
+
+
+@pytest.mark.parametrize("head", ['[{"odai": "お題", "ans": "', '{"odai": "お題", "ans": "'])
+def test_unterminated_record_does_not_read_to_the_end(head):
+    # 閉じていない文字列のあとにファイルの残り全部が続く（改行もない）
+    f = CountingReader(head + "x" * 100000)
+    with pytest.raises(ValueError):
+        list(iter_json_records(f, chunk_size=64, max_record_size=1024))
+    assert f.read_chars < 2048
+
+
+def test_records_up_to_the_limit_are_read():
+    records = [{"ans": "x" * 900}, {"ans": "y" * 900}]
+    text = json.dumps(records)
+    f = io.StringIO(text)
+    assert list(iter_json_records(f, chunk_size=64, max_record_size=1024)) == records
+    f = io.StringIO("\n".join(json.dumps(r) for r in records))
+    assert list(iter_json_records(f, chunk_size=64, max_record_size=1024)) == records
+
+
+def test_normalize_record():
+    assert normalize_record({"odai": "お題", "ans": "回答"}) == {"odai": "お題", "ans": "回答", "style": "通常"}
+    assert normalize_record({"odai": "お題", "ans": "回答", "style": "ブラック"})["style"] == "ブラック"
+    assert normalize_record({"odai": "お題", "ans": " "}) is None
+    assert normalize_record({"odai": "お題"}) is None
+    assert normalize_record(["お題", "回答"]) is None
@@ -0,0 +1,148 @@
+# 学習データのストア（SQLite）と類似検索インデックスのテスト
+import pytest
+
+import oogiri_core
+from oogiri_core import ExampleIndex, LearningStore
+
+SEED = [
+    {"odai": "孫がブチギレ。何があった？", "ans": "入れ歯を売った", "style": "通常"},
+    {"odai": "サウナで怒られた。なぜ？", "ans": "水風呂で泳いだ", "style": "ブラック"},
+]
+
+
+@pytest.fixture(autouse=True)
+def seed(monkeypatch):
+    # 初回の取り込みは learning_data.json ではなく SEED から行う
+    monkeypatch.setattr(oogiri_core, "load_data", lambda: [dict(item) for item in SEED])
+
+
+@pytest.fixture
+def db(tmp_path):
+    return str(tmp_path / "learning.db")
+
+
+def row_of(store, example_id):
+    return next((r for r in store.all() if r["id"] == example_id), None)
+
+
+def test_seeds_only_once(db):
+    store = LearningStore(db)
+    assert [(r["odai"], r["ans"]) for r in store.all()] == [(s["odai"], s["ans"]) for s in SEED]
+    store.replace_all([])
+    # 全件消したあとに開き直しても、初期データを取り込み直さない
+    assert LearningStore(db).all() == []
+
+
+def test_add_dedup_update_delete(db):
+    store = LearningStore(db)
+    new_id = store.add("無人島に1つだけ持っていくもの", "Wi-Fi", "知的")
+    assert new_id is not None
+    assert store.add("無人島に1つだけ持っていくもの", "Wi-Fi") is None
+    assert store.exists("無人島に1つだけ持っていくもの", "Wi-Fi")
+
+    assert store.update(new_id, ans="充電器", style="通常")
+    assert row_of(store, new_id) == {"id": new_id, "odai": "無人島に1つだけ持っていくもの", "ans": "充電器", "style": "通常"}
+    # 更新後の組がほかと重複するなら更新しない
+    first = store.all()[0]
+    other = store.add(first["odai"], "別の回答")
+    assert not store.update(other, ans=first["ans"])
+
+    store.delete(new_id)
+    assert row_of(store, new_id) is None
+
+
+def test_other_instance_sees_writes(db):
+    a = LearningStore(db)
+    b = LearningStore(db)
+    assert len(a.all()) == len(b.all()) == 2
+    new_id = a.add("母親に怒られた理由", "冷蔵庫で寝た")
+    # 別プロセス相当のインスタンスでも、バージョン番号が変わったので読み直す
+    assert row_of(b, new_id)["ans"] == "冷蔵庫で寝た"
+
+
+def test_replace_all(db):
+    store = LearningStore(db)
+    assert store.replace_all([{"odai": "入れ替え", "ans": "だけ"}, {"odai": "入れ替え", "ans": "だけ"}]) == 1
+    assert [(r["odai"], r["style"]) for r in store.all()] == [("入れ替え", "通常")]
+
+
+def test_similar_prefers_style_and_fills_with_recent(db):
+    store = LearningStore(db)
+    picked = store.similar("サウナで怒られた", k=1, style="ブラック")
+    assert picked[0]["ans"] == "水風呂で泳いだ"
+    # 近い例が足りなければ新しい例で埋める
+    picked = store.similar("まったく関係ない", k=2)
+    assert {r["ans"] for r in picked} == {s["ans"] for s in SEED}
+
+
+def test_similar_follows_updates(db):
+    store = LearningStore(db)
+    new_id = store.add("母親に怒られた理由", "冷蔵庫で寝た")
+    assert store.similar("冷蔵庫", k=1)[0]["id"] == new_id
+    store.delete(new_id)
+    assert all(r["id"] != new_id for r in store.similar("冷蔵庫", k=3))
+
+
+def test_index_add_remove():
+    index = ExampleIndex()
+    index.add({"id": 1, "odai": "孫がブチギレ", "ans": "入れ歯を売った", "style": "通常"})
+    index.add({"id": 2, "odai": "サウナで怒られた", "ans": "水風呂で泳いだ", "style": "ブラック"})
+    assert index.search("孫がブチギレた", k=5) == [1]
+    assert index.search("怒られた", k=5, style="通常") == []
+    assert index.candidates("入れ歯") == {1}
+    assert index.candidates("歯") is None   # n-gram より短いと絞れない
+
+    index.remove(1)
+    assert index.search("孫がブチギレた", k=5) == []
+    assert index.candidates("入れ歯") == set()
+    assert "入れ" not in index.postings
+    # 同じ id で追加し直すと前の内容は消える
+    index.add({"id": 2, "odai": "母親", "ans": "冷蔵庫", "style": "通常"})
+    assert index.search("サウナ", k=5) == []
+    assert index.total_len == index.docs[2][1]
+
+
+def test_find_ignores_whitespace_filters_style_and_pages(db):
+    store = LearningStore(db)
+    store.add_many([{"odai": f"お題 {i}", "ans": f"回答 {i}", "style": "知的" if i % 2 else "通常"} for i in range(30)])
+
+    total, rows = store.find("題1")
+    assert total == 11   # お題 1, 10〜19
+    assert rows[0]["odai"] == "お題 19"   # 新しい順
+
+    total, rows = store.find("", style="知的", offset=10, limit=5)
+    assert total == 15
+    assert [r["style"] for r in rows] == ["知的"] * 5
+
+    assert store.find("水風呂")[1][0]["ans"] == "水風呂で泳いだ"
+    assert store.find("存在しない文字列")[0] == 0
+
+
+def test_get_and_find_follow_writes(db):
+    store = LearningStore(db)
+    new_id = store.add("無人島に1つだけ持っていくもの", "充電器")
+    assert store.get(new_id)["ans"] == "充電器"
+    assert store.find("充電器")[0] == 1
+    store.delete(new_id)
+    assert store.get(new_id) is None
+    assert store.find("充電器") == (0, [])
+
+
+def test_import_records_counts(db):
+    store = LearningStore(db)
+    records = [
+        {"odai": "新しいお題", "ans": "新しい回答"},
+        {"odai": "新しいお題", "ans": "新しい回答"},   # ファイル内の重複
+        dict(SEED[0]),                                  # 既存との重複
+        {"odai": "種別が変", "ans": "回答", "style": "不明"},
+        "文字列",
+    ]
+    seen = []
+    counts = store.import_records(iter(records), batch_size=2, progress=seen.append)
+    assert counts == {"added": 1, "duplicates": 2, "invalid": 2}
+    assert seen[-1] == len(records)
+    assert len(store.all()) == 3
+
+    counts = store.import_records(iter([{"odai": "入れ替え", "ans": "だけ"}]), replace=True)
+    assert counts["added"] == 1
+    assert [r["odai"] for r in store.all()] == ["入れ替え"]
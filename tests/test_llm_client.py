@@ -0,0 +1,130 @@
+# 応答キャッシュ付き LLM クライアントのテスト（手元の偽モデルで動かす）
+import json
+import os
+
+import pytest
+
+from oogiri_core import LLMClient, generate_odais, stream_answers
+
+ODAIS = "1. 孫がブチギレ。いったい何があった？\n2. サウナで怒られた。いったいなぜ？\n"
+ANSWERS = "1. 入れ歯を売った\n2. 水風呂で泳いだ\n"
+REFUSAL = "お応えできません。"   # 番号もなく、お題としても短すぎる応答
+
+
+class StubBackend:
+    """呼ばれた回数を数え、決められた応答を返す偽モデル"""
+
+    def __init__(self, text):
+        self.text = text
+        self.calls = 0
+
+    def generate(self, model, prompt, params):
+        self.calls += 1
+        return self.text
+
+    def stream(self, model, prompt, params):
+        self.calls += 1
+        # 1文字ずつ届くストリーミング応答
+        yield from self.text
+
+
+class StubStore:
+    def similar(self, query, k, style=None):
+        return []
+
+
+@pytest.fixture
+def make_client(tmp_path):
+    def make(text, ttl=3600):
+        backend = StubBackend(text)
+        return LLMClient(backend, cache_dir=str(tmp_path / "llm"), ttl=ttl), backend
+    return make
+
+
+def test_generate_hit(make_client):
+    client, backend = make_client(ODAIS)
+    assert client.generate("お題") == ODAIS
+    assert client.generate("お題") == ODAIS
+    assert backend.calls == 1
+    # プロンプトやパラメータが違えば別のキー
+    client.generate("別のお題")
+    client.generate("お題", params={"temperature": 1.0})
+    assert backend.calls == 3
+
+
+def test_stream_hit_returns_whole_text(make_client):
+    client, backend = make_client(ANSWERS)
+    assert "".join(client.stream("回答")) == ANSWERS
+    assert list(client.stream("回答")) == [ANSWERS]
+    assert backend.calls == 1
+
+
+def test_force_fresh_calls_again_and_overwrites(make_client):
+    client, backend = make_client(ODAIS)
+    client.generate("お題")
+    backend.text = "1. 新しいお題です。いったい何があった？"
+    assert client.generate("お題", force_fresh=True) == backend.text
+    assert client.generate("お題") == backend.text
+    assert backend.calls == 2
+
+
+def test_expired_entry_is_not_used(make_client):
+    client, backend = make_client(ODAIS, ttl=60)
+    client.generate("お題")
+    path = client.cache_path("models/gemini-2.0-flash", "お題", None)
+    with open(path, encoding="utf-8") as f:
+        entry = json.load(f)
+    entry["created"] -= 61
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(entry, f)
+    client.generate("お題")
+    assert backend.calls == 2
+
+
+def test_stream_is_cached_only_when_read_to_the_end(make_client):
+    client, backend = make_client(ANSWERS)
+    stream = client.stream("回答")
+    next(stream)
+    stream.close()
+    assert not os.path.exists(client.cache_dir) or not os.listdir(client.cache_dir)
+    assert "".join(client.stream("回答")) == ANSWERS
+    assert backend.calls == 2
+    assert list(client.stream("回答")) == [ANSWERS]
+    assert backend.calls == 2
+
+
+@pytest.mark.parametrize("text", ["", "  \n"])
+def test_empty_response_is_not_cached(make_client, text):
+    client, backend = make_client(text)
+    assert client.generate("お題") == text
+    assert "".join(client.stream("回答")) == text
+    client.generate("お題")
+    list(client.stream("回答"))
+    assert backend.calls == 4
+
+
+def test_unusable_entry_saved_earlier_is_ignored(make_client):
+    client, backend = make_client(ODAIS)
+    os.makedirs(client.cache_dir)
+    with open(client.cache_path("models/gemini-2.0-flash", "お題", None), "w", encoding="utf-8") as f:
+        json.dump({"created": 9e18, "text": ""}, f)
+    assert client.generate("お題") == ODAIS
+    assert backend.calls == 1
+
+
+def test_refusal_is_not_cached(make_client):
+    client, backend = make_client(REFUSAL)
+    assert generate_odais("サウナ", client=client) == []
+    assert list(stream_answers("孫がブチギレ", client=client, store=StubStore())) == []
+    assert generate_odais("サウナ", client=client) == []
+    assert list(stream_answers("孫がブチギレ", client=client, store=StubStore())) == []
+    assert backend.calls == 4
+
+    # 使える応答が返ってきたら、そこからはキャッシュを使う
+    backend.text = ODAIS
+    assert len(generate_odais("サウナ", client=client)) == 2
+    assert len(generate_odais("サウナ", client=client)) == 2
+    backend.text = ANSWERS
+    assert list(stream_answers("孫がブチギレ", client=client, store=StubStore())) == ["入れ歯を売った", "水風呂で泳いだ"]
+    assert list(stream_answers("孫がブチギレ", client=client, store=StubStore())) == ["入れ歯を売った", "水風呂で泳いだ"]
+    assert backend.calls == 6